@@ -0,0 +1,219 @@
+"""Stand-in Ollama server for benchmarks and local testing.
+
+Implements the parts of the Ollama API the chat API uses (/api/tags, /api/ps,
+/api/chat streamed and not, /api/generate and /api/pull) with configurable
+latency and token rate, so llmapi.py can be load-tested without a GPU:
+
+    python bench/fake_ollama.py --port 11434 --latency 0.05 --tokens-per-second 200
+
+GET /_stats returns the number of calls per path and POST /_stats/reset clears
+them; the benchmark harness uses these to count upstream calls per request.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOllama:
+    """Model state and timing settings shared by all request handlers."""
+
+    def __init__(self, models, latency=0.05, tokens_per_second=200.0, reply_tokens=32,
+                 load_seconds=0.2, pull_seconds=0.5):
+        self.models = list(models)
+        self.loaded = set()
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.load_seconds = load_seconds
+        self.pull_seconds = pull_seconds
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def count(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+    def reply_words(self, prompt):
+        words = (prompt.split() or ["ok"]) * self.reply_tokens
+        return words[:self.reply_tokens]
+
+    def token_delay(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def stats(self, model, tokens, started):
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        return {
+            "model": model,
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int(elapsed * 1e9),
+            "prompt_eval_count": 16,
+            "prompt_eval_duration": int(self.latency * 1e9),
+            "eval_count": tokens,
+            "eval_duration": int(max(elapsed - self.latency, 1e-6) * 1e9)
+        }
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open many connections at once; the default backlog of 5 drops some
+    request_queue_size = 1024
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_ndjson(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_chunk(self, payload):
+        line = json.dumps(payload).encode() + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        fake = self.fake
+        if self.path == "/_stats":
+            with fake.lock:
+                return self.send_json({"calls": dict(fake.calls)})
+        fake.count(self.path)
+        if self.path == "/api/tags":
+            self.send_json({"models": [{"name": name, "model": name} for name in fake.models]})
+        elif self.path == "/api/ps":
+            self.send_json({"models": [{"name": name, "model": name} for name in sorted(fake.loaded)]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        fake = self.fake
+        if self.path == "/_stats/reset":
+            with fake.lock:
+                fake.calls.clear()
+            return self.send_json({"success": True})
+        fake.count(self.path)
+        body = self.read_json()
+        handler = {
+            "/api/chat": self.chat,
+            "/api/generate": self.generate,
+            "/api/pull": self.pull
+        }.get(self.path)
+        if handler is None:
+            return self.send_json({"error": "not found"}, 404)
+        handler(body)
+
+    def chat(self, body):
+        fake = self.fake
+        model = body.get("model")
+        if model not in fake.models:
+            return self.send_json({"error": f"model '{model}' not found"}, 404)
+        started = time.perf_counter()
+        fake.loaded.add(model)
+        messages = body.get("messages") or [{"content": ""}]
+        words = fake.reply_words(messages[-1].get("content", ""))
+        time.sleep(fake.latency)
+
+        if not body.get("stream", True):
+            time.sleep(fake.token_delay() * len(words))
+            return self.send_json({
+                **fake.stats(model, len(words), started),
+                "message": {"role": "assistant", "content": " ".join(words)}
+            })
+
+        self.start_ndjson()
+        for i, word in enumerate(words):
+            content = word if i == 0 else " " + word
+            self.send_chunk({"model": model, "message": {"role": "assistant", "content": content}, "done": False})
+            time.sleep(fake.token_delay())
+        self.send_chunk({**fake.stats(model, len(words), started), "message": {"role": "assistant", "content": ""}})
+        self.end_chunks()
+
+    def generate(self, body):
+        fake = self.fake
+        model = body.get("model")
+        if model not in fake.models:
+            return self.send_json({"error": f"model '{model}' not found"}, 404)
+        if body.get("keep_alive") == 0:
+            fake.loaded.discard(model)
+            return self.send_json({"model": model, "response": "", "done": True, "done_reason": "unload"})
+        time.sleep(fake.load_seconds)
+        fake.loaded.add(model)
+        self.send_json({"model": model, "response": "", "done": True, "done_reason": "load"})
+
+    def pull(self, body):
+        fake = self.fake
+        model = body.get("name") or body.get("model")
+        steps = 4
+        if body.get("stream", True):
+            self.start_ndjson()
+            self.send_chunk({"status": "pulling manifest"})
+            for step in range(1, steps + 1):
+                time.sleep(fake.pull_seconds / steps)
+                self.send_chunk({"status": "downloading", "total": steps * 100, "completed": step * 100})
+        else:
+            time.sleep(fake.pull_seconds)
+        if model not in fake.models:
+            fake.models.append(model)
+        if body.get("stream", True):
+            self.send_chunk({"status": "success"})
+            self.end_chunks()
+        else:
+            self.send_json({"status": "success"})
+
+def serve(host, port, fake):
+    handler = type("BoundHandler", (Handler,), {"fake": fake})
+    return FakeServer((host, port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--models", default="llama3:latest,qwen2:latest",
+                        help="comma-separated models listed by /api/tags")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="0 sends all tokens at once")
+    parser.add_argument("--reply-tokens", type=int, default=32, help="tokens per reply")
+    parser.add_argument("--load-seconds", type=float, default=0.2, help="time /api/generate takes to load a model")
+    parser.add_argument("--pull-seconds", type=float, default=0.5, help="time /api/pull takes")
+    args = parser.parse_args()
+
+    fake = FakeOllama(
+        [name for name in args.models.split(",") if name],
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        load_seconds=args.load_seconds,
+        pull_seconds=args.pull_seconds
+    )
+    server = serve(args.host, args.port, fake)
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
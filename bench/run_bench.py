@@ -0,0 +1,368 @@
+"""Benchmark harness for the chat API.
+
+By default it starts bench/fake_ollama.py and a copy of the API (Flask or ASGI)
+wired to it in a temporary directory, then drives each scenario at each
+concurrency level and reports p50/p95/p99 latency, requests/s and Ollama calls
+per request:
+
+    python bench/run_bench.py --server asgi --concurrency 1,8,32 --requests 200 --output results.json
+
+Pass --baseline with an earlier results file to fail (exit status 1) when a
+scenario got slower, lost throughput or started making more Ollama calls. Use
+--url and --ollama-url to benchmark servers that are already running instead.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+
+SCENARIOS = ["chat", "chat_stream", "chat_cached", "chat_batch", "models", "loaded_model", "load_stop"]
+# Run at concurrency 1 only: parallel workers would load and stop the same model
+# under each other and measure that race rather than the API
+SERIAL_SCENARIOS = {"load_stop"}
+
+def percentile(values, q):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+class Scenario:
+    """One kind of request; run() performs it once and returns the time to first byte."""
+
+    def __init__(self, session, base_url, model, users):
+        self.session = session
+        self.base_url = base_url
+        self.model = model
+        self.users = users
+
+    def post(self, path, payload, stream=False):
+        return self.session.post(f"{self.base_url}{path}", json=payload, stream=stream, timeout=300)
+
+    def check(self, response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.request.method} {response.request.path_url}: {response.status_code}")
+
+    def run(self, name, i):
+        started = time.perf_counter()
+        user_id = f"bench-{i % self.users}"
+        if name == "chat":
+            response = self.post("/chat", {"user_id": user_id, "model": self.model, "message": f"hello {i}", "stream": False})
+        elif name == "chat_stream":
+            response = self.post("/chat", {"user_id": user_id, "model": self.model, "message": f"hello {i}", "stream": True},
+                                 stream=True)
+            self.check(response)
+            ttfb = None
+            for chunk in response.iter_content(chunk_size=None):
+                if ttfb is None and chunk:
+                    ttfb = time.perf_counter() - started
+            return ttfb
+        elif name == "chat_cached":
+            # Same deterministic prompt every time: all but the first are cache hits
+            response = self.post("/chat", {"user_id": user_id, "model": self.model, "message": "What is 2 + 2?",
+                                           "use_context": False, "options": {"temperature": 0}, "stream": False})
+        elif name == "chat_batch":
+            items = [{"user_id": f"{user_id}-{n}", "model": self.model, "message": f"batch {i}.{n}"} for n in range(8)]
+            response = self.post("/chat/batch", {"items": items}, stream=True)
+            self.check(response)
+            lines = [json.loads(line) for line in response.iter_lines() if line]
+            if any("error" in line for line in lines):
+                raise RuntimeError("batch item failed")
+            return None
+        elif name == "models":
+            response = self.session.get(f"{self.base_url}/models", timeout=60)
+        elif name == "loaded_model":
+            response = self.session.get(f"{self.base_url}/loaded-model", timeout=60)
+        elif name == "load_stop":
+            response = self.post("/load-model", {"model": self.model})
+            self.check(response)
+            response = self.post("/stop-model", {"model": self.model})
+        else:
+            raise ValueError(f"Unknown scenario {name}")
+        self.check(response)
+        return None
+
+def fetch_upstream_calls(ollama_url):
+    """Per-path call counts from the fake server, or None if the target is not one."""
+    if not ollama_url:
+        return None
+    try:
+        response = requests.get(f"{ollama_url}/_stats", timeout=5)
+        return response.json()["calls"] if response.status_code == 200 else None
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+
+def reset_upstream_calls(ollama_url):
+    if ollama_url:
+        try:
+            requests.post(f"{ollama_url}/_stats/reset", timeout=5)
+        except requests.RequestException:
+            pass
+
+def run_level(args, name, concurrency):
+    """Runs args.requests requests of one scenario with concurrency workers."""
+    sessions = threading.local()
+    latencies = []
+    ttfbs = []
+    errors = []
+    counter = iter(range(args.requests + args.warmup))
+    lock = threading.Lock()
+
+    def scenario():
+        if not hasattr(sessions, "scenario"):
+            sessions.scenario = Scenario(requests.Session(), args.url, args.model, args.users)
+        return sessions.scenario
+
+    # Warm-up requests fill caches and connection pools outside the measurement
+    for i in range(args.warmup):
+        try:
+            scenario().run(name, next(counter))
+        except Exception:
+            pass
+    reset_upstream_calls(args.ollama_url)
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                ttfb = scenario().run(name, i)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if ttfb is not None:
+                    ttfbs.append(ttfb)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    wall = time.perf_counter() - started
+
+    upstream = fetch_upstream_calls(args.ollama_url)
+    latencies.sort()
+    ttfbs.sort()
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    result = {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "ttfb_p50_ms": ms(percentile(ttfbs, 50)),
+        "requests_per_second": round(len(latencies) / wall, 2) if wall else None,
+        "upstream_calls_per_request": None,
+        "upstream_calls": upstream
+    }
+    if upstream is not None and latencies:
+        result["upstream_calls_per_request"] = round(sum(upstream.values()) / len(latencies), 3)
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+def start_servers(args, workdir):
+    """Starts the fake Ollama server and a copy of the API configured against it."""
+    processes = []
+    ollama_port = free_port()
+    processes.append(subprocess.Popen([
+        sys.executable, os.path.join(bench_dir, "fake_ollama.py"),
+        "--port", str(ollama_port),
+        "--models", args.model,
+        "--latency", str(args.latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--reply-tokens", str(args.reply_tokens)
+    ], stdout=subprocess.DEVNULL))
+    args.ollama_url = f"http://127.0.0.1:{ollama_port}"
+    wait_until_up(f"{args.ollama_url}/api/tags")
+
+    # llmapi reads config.json next to itself, so run a copy from a scratch directory
+    for name in ("llmapi.py", "llmapi_asgi.py"):
+        shutil.copy(os.path.join(repo_dir, name), workdir)
+    api_port = free_port()
+    config = {
+        "ollama_server": args.ollama_url,
+        "flask_host": "127.0.0.1",
+        "flask_port": api_port,
+        "log_level": "WARNING",
+        "scheduler": {"default": {"max_in_flight": 64, "max_queue": 4096, "max_wait": 300}, "models": {}}
+    }
+    config.update(json.loads(args.config) if args.config else {})
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "llmapi_asgi:app", "--host", "127.0.0.1",
+                   "--port", str(api_port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "llmapi.py"]
+    processes.append(subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    args.url = f"http://127.0.0.1:{api_port}"
+    wait_until_up(f"{args.url}/queue")
+    return processes
+
+def compare(results, baseline, threshold):
+    """Lists regressions of results against a baseline results document."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+        label = f"{result['scenario']} @ {result['concurrency']}"
+        if before.get("p95_ms") and result["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{label}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if (before.get("requests_per_second") and result["requests_per_second"] is not None
+                and result["requests_per_second"] < before["requests_per_second"] * (1 - threshold)):
+            regressions.append(f"{label}: {before['requests_per_second']} -> {result['requests_per_second']} req/s")
+        if (before.get("upstream_calls_per_request") is not None and result["upstream_calls_per_request"] is not None
+                and result["upstream_calls_per_request"] > before["upstream_calls_per_request"] + 0.01):
+            regressions.append(f"{label}: upstream calls/request {before['upstream_calls_per_request']} "
+                               f"-> {result['upstream_calls_per_request']}")
+        if result["errors"] > before.get("errors", 0):
+            regressions.append(f"{label}: {before.get('errors', 0)} -> {result['errors']} errors")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(results):
+    header = f"{'scenario':<14}{'conc':>5}{'reqs':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'up/req':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cells = [r["p50_ms"], r["p95_ms"], r["p99_ms"], r["requests_per_second"], r["upstream_calls_per_request"]]
+        p50, p95, p99, rps, upstream = ("-" if value is None else value for value in cells)
+        print(f"{r['scenario']:<14}{r['concurrency']:>5}{r['requests']:>7}{r['errors']:>5}"
+              f"{p50:>10}{p95:>10}{p99:>10}{rps:>10}{upstream:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat API against a fake Ollama server")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask", help="which entry point to start")
+    parser.add_argument("--scenarios", default="chat,chat_stream,chat_cached,models,loaded_model",
+                        help=f"comma-separated, from: {', '.join(SCENARIOS)}; "
+                             f"{', '.join(sorted(SERIAL_SCENARIOS))} always runs one request at a time")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario and level")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests before each level")
+    parser.add_argument("--users", type=int, default=50, help="distinct user_ids the chat scenarios rotate over")
+    parser.add_argument("--model", default="llama3:latest")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Ollama: seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="fake Ollama: token rate")
+    parser.add_argument("--reply-tokens", type=int, default=32, help="fake Ollama: tokens per reply")
+    parser.add_argument("--config", help="JSON merged into the generated config.json")
+    parser.add_argument("--url", help="benchmark an already running API instead of starting one")
+    parser.add_argument("--ollama-url", help="with --url: the fake Ollama server it talks to, for call counts")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+
+    external = bool(args.url)
+    processes = []
+    workdir = None
+    try:
+        if not external:
+            workdir = tempfile.mkdtemp(prefix="llmapi-bench-")
+            processes = start_servers(args, workdir)
+        results = []
+        for name in scenarios:
+            for concurrency in [1] if name in SERIAL_SCENARIOS else levels:
+                result = run_level(args, name, concurrency)
+                results.append(result)
+                print(f"{name} @ {concurrency}: p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, "
+                      f"{result['requests_per_second']} req/s, {result['errors']} errors", file=sys.stderr)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    document = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": git_revision(),
+            "server": "external" if external else args.server,
+            "python": platform.python_version(),
+            "requests": args.requests,
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "reply_tokens": args.reply_tokens
+        },
+        "results": results
+    }
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -1,345 +1,3618 @@
 import re
 import requests
 import sqlite3
+import atexit
+import signal
+import contextvars
+import copy
+import functools
+import hashlib
+import hmac
 import json
 import logging
 import os
+import threading
 import time
-from flask import Flask, request, jsonify
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty, SimpleQueue
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Blueprint, Flask, Response, g, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
-# Basic logging setup with stream handler only
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s: %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+
 logger = logging.getLogger(__name__)
 
-# Get script directory
-script_dir = os.path.dirname(os.path.abspath(__file__))
+# Get script directory
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Default config
+default_config = {
+    "log_path": "flask.log",
+    "log_level": "INFO",
+    "log_json": False,
+    "log_max_bytes": 10485760,
+    "log_backup_count": 5,
+    "log_max_payload": 1000,
+    "ollama_server": "http://localhost:11434",
+    "use_context": True,
+    "context_echo": "delta",
+    "flask_host": "0.0.0.0",
+    "flask_port": 6000,
+    "flask_debug": False,
+    "db_path": "user_contexts.db",
+    "db_busy_timeout": 5,
+    "maintenance": {
+        "interval": 3600,
+        "context_ttl": 0,
+        "max_messages": 0,
+        "batch_size": 500,
+        "vacuum_pages": 2000,
+        "analyze": True
+    },
+    "admin_token": None,
+    "context_window": {
+        "default": {"max_tokens": 4096, "reserve_tokens": 1024, "summarize": False},
+        "models": {}
+    },
+    "scheduler": {
+        "default": {"max_in_flight": 4, "max_queue": 32, "max_wait": 120},
+        "models": {}
+    },
+    "response_cache": {"enabled": True, "max_bytes": 16777216, "ttl": 3600, "disk_path": None},
+    "context_cache": {"enabled": False, "max_bytes": 67108864, "max_delay": 1.0, "flush_batch": 500},
+    "idempotency": {"enabled": True, "ttl": 3600, "max_entries": 1000},
+    "rate_limit": {"enabled": False, "rate": 1.0, "burst": 10, "disk_path": None},
+    "db_statement_cache": 128,
+    "model_cache_ttl": 5,
+    "ollama_pool_size": 10,
+    "ollama_retries": 2,
+    "ollama_retry_backoff": 0.5,
+    "ollama_connect_timeout": 5,
+    "ollama_read_timeout": 60,
+    "ollama_poll_timeout": 10,
+    "ollama_pull_timeout": 600,
+    "backend_health_interval": 10,
+    "backend_max_failures": 3,
+    "backend_eject_seconds": 30,
+    "backend_pin_ttl": 1800,
+    "model_ready_timeout": 120,
+    "model_unload_timeout": 30,
+    "asgi_max_connections": 500,
+    "server_timing": False,
+    "batch_max_items": 1000,
+    "batch_workers": 16,
+    "config_watch_interval": 2
+}
+
+config_path = os.path.join(script_dir, 'config.json')
+# Filled in from config.json by initialize(); until then every setting has its default
+config = {}
+
+def read_config(strict=False):
+    """Reads config.json, creating it with the defaults if it is missing.
+
+    An unreadable or invalid file falls back to the defaults, or raises when strict.
+    """
+    try:
+        with open(config_path, 'r') as f:
+            loaded = json.load(f)
+        if not isinstance(loaded, dict):
+            raise ValueError("top level must be an object")
+        logger.info('Config loaded successfully')
+        return loaded
+    except FileNotFoundError:
+        if strict:
+            raise
+        logger.info('Config file not found at %s; creating with defaults', config_path)
+        with open(config_path, 'w') as f:
+            json.dump(default_config, f, indent=4)
+        return default_config
+    except ValueError as e:
+        if strict:
+            raise
+        logger.warning('Invalid JSON in config file: %s, using defaults', e)
+        return default_config
+    except Exception as e:
+        if strict:
+            raise
+        logger.warning('Failed to load config: %s, using defaults', e)
+        return default_config
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a single JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener.
+
+    The stock prepare() formats the record on the logging thread and drops its
+    exc_info; this one only merges the arguments into the message, so the
+    listener's formatters still see the exception.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+log_listener = None
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+def configure_logging(config):
+    """Send records through a queue so formatting and file writes happen off the
+    request thread, on a listener feeding stderr and a rotating log file. Only the
+    message arguments are resolved on the logging thread."""
+    global log_listener
+    formatter = JsonFormatter() if config.get('log_json', False) else logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    log_path = config.get('log_path', 'flask.log')
+    if not os.path.isabs(log_path):
+        log_path = os.path.join(script_dir, log_path)
+    file_error = None
+    try:
+        handlers.append(RotatingFileHandler(
+            log_path,
+            maxBytes=config.get('log_max_bytes', 10485760),
+            backupCount=config.get('log_backup_count', 5)
+        ))
+    except Exception as e:
+        file_error = e
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    stop_logging()
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    level = str(config.get('log_level', 'INFO')).upper()
+    try:
+        root.setLevel(level)
+    except ValueError:
+        root.setLevel(logging.INFO)
+        logger.warning('Unknown log_level %s; using INFO', level)
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    if file_error is None:
+        logger.info('File logging enabled at %s', log_path)
+    else:
+        logger.warning('Failed to add file handler: %s', file_error)
+
+class Truncated:
+    """Log argument that is only converted to text, and cut to log_max_payload
+    characters, if the record is actually emitted."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= LOG_MAX_PAYLOAD:
+            return text
+        return f"{text[:LOG_MAX_PAYLOAD]}... [{len(text) - LOG_MAX_PAYLOAD} more characters]"
+
+# JSON codec: orjson when it is installed, the standard library otherwise. Both
+# produce compact UTF-8; json_dumps returns bytes and json_loads takes bytes or str.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def json_dumps(obj, sort_keys=False):
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            # Values orjson refuses (e.g. integers over 64 bits) still encode the slow way
+            return json.dumps(obj, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode()
+
+    json_loads = orjson.loads
+else:
+    JSON_BACKEND = "json"
+
+    def json_dumps(obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode()
+
+    json_loads = json.loads
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def apply_config(new_config):
+    """Points config and the module-level settings below at new_config.
+
+    Called with {} at import (so every setting has its default), by initialize()
+    and on each reload; request handlers read these globals at call time.
+    """
+    global config, OLLAMA_SERVER, USE_CONTEXT, flask_host, flask_port, flask_debug, MODEL_CACHE_TTL, \
+        MODEL_READY_TIMEOUT, MODEL_UNLOAD_TIMEOUT, CONTEXT_WINDOW, BATCH_MAX_ITEMS, BATCH_WORKERS, SCHEDULER, \
+        RESPONSE_CACHE, CONTEXT_CACHE, MAINTENANCE, ADMIN_TOKEN, CONTEXT_ECHO, db_path, SERVER_TIMING, LOG_MAX_PAYLOAD, \
+        IDEMPOTENCY, RATE_LIMIT
+    config = new_config
+    LOG_MAX_PAYLOAD = config.get('log_max_payload', 1000)
+    OLLAMA_SERVER = config.get('ollama_server', os.getenv("OLLAMA_SERVER", "http://localhost:11434"))
+    USE_CONTEXT = config.get('use_context', True)
+    flask_host = config.get('flask_host', "0.0.0.0")
+    flask_port = config.get('flask_port', 6000)
+    flask_debug = config.get('flask_debug', False)
+    MODEL_CACHE_TTL = config.get('model_cache_ttl', 5)
+    MODEL_READY_TIMEOUT = config.get('model_ready_timeout', 120)
+    MODEL_UNLOAD_TIMEOUT = config.get('model_unload_timeout', 30)
+    CONTEXT_WINDOW = config.get('context_window', {})
+    BATCH_MAX_ITEMS = config.get('batch_max_items', 1000)
+    BATCH_WORKERS = config.get('batch_workers', 16)
+    SCHEDULER = config.get('scheduler', {})
+    RESPONSE_CACHE = config.get('response_cache', {})
+    CONTEXT_CACHE = config.get('context_cache', {})
+    MAINTENANCE = config.get('maintenance', {})
+    IDEMPOTENCY = config.get('idempotency', {})
+    RATE_LIMIT = config.get('rate_limit', {})
+    ADMIN_TOKEN = config.get('admin_token')
+    # How much history /chat echoes back: "full", "delta" (just this turn) or "none"
+    CONTEXT_ECHO = config.get('context_echo', "delta")
+
+    # Database path
+    db_config_path = config.get('db_path', 'user_contexts.db')
+    if os.path.isabs(db_config_path):
+        db_path = db_config_path
+    else:
+        db_path = os.path.join(script_dir, db_config_path)
+
+    SERVER_TIMING = config.get('server_timing', False)
+
+apply_config({})
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Counter:
+    """Prometheus-style counter with labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]  # buckets, count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, counts in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    out.append((f"{self.name}_bucket", self._labels(key, [("le", str(bound))]), count))
+                out.append((f"{self.name}_bucket", self._labels(key, [("le", "+Inf")]), counts[-2]))
+                out.append((f"{self.name}_count", self._labels(key), counts[-2]))
+                out.append((f"{self.name}_sum", self._labels(key), counts[-1]))
+        return out
+
+metrics = []
+metrics_collectors = []  # callables run before rendering to refresh gauges
+
+def render_metrics():
+    """Renders every registered metric in the Prometheus text exposition format."""
+    for collect in metrics_collectors:
+        try:
+            collect()
+        except Exception as e:
+            logger.error("Metrics collector failed: %s", e)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+CHAT_STAGE_SECONDS = Histogram('chat_stage_seconds', 'Time spent in each /chat stage', ('stage',))
+CHAT_FIRST_TOKEN_SECONDS = Histogram('chat_first_token_seconds', 'Time from the upstream call to the first streamed token', ('model',))
+HTTP_REQUESTS = Counter('http_requests_total', 'API requests by route and status', ('method', 'path', 'status'))
+UPSTREAM_REQUESTS = Counter('ollama_requests_total', 'Ollama API calls by path and status', ('path', 'status'))
+UPSTREAM_SECONDS = Histogram('ollama_request_seconds', 'Time until Ollama response headers arrive', ('path',))
+DB_SECONDS = Histogram('db_query_seconds', 'Context database call latency', ('op',),
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+OLLAMA_EVAL_TOKENS = Counter('ollama_eval_tokens_total', 'Tokens generated (eval_count)', ('model',))
+OLLAMA_PROMPT_TOKENS = Counter('ollama_prompt_eval_tokens_total', 'Prompt tokens evaluated (prompt_eval_count)', ('model',))
+OLLAMA_EVAL_SECONDS = Histogram('ollama_eval_seconds', 'Generation time reported by Ollama (eval_duration)', ('model',))
+OLLAMA_PROMPT_EVAL_SECONDS = Histogram('ollama_prompt_eval_seconds', 'Prompt evaluation time reported by Ollama (prompt_eval_duration)', ('model',))
+OLLAMA_TOKENS_PER_SECOND = Histogram('ollama_tokens_per_second', 'Generation speed (eval_count / eval_duration)', ('model',),
+                                     buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400))
+
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def start_request_timing():
+    """Starts collecting stage timings for the current request (for Server-Timing)."""
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        CHAT_STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+def server_timing_header(timings):
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings)
+
+@contextmanager
+def timed_db(op):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - start, op=op)
+
+def db_timed(op):
+    """Records the decorated database call's latency under db_query_seconds."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_db(op):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_generation_stats(model, result):
+    """Records Ollama's own counters from a finished /api/chat result."""
+    eval_count = result.get("eval_count")
+    eval_duration = result.get("eval_duration")
+    if eval_count:
+        OLLAMA_EVAL_TOKENS.inc(eval_count, model=model)
+    if result.get("prompt_eval_count"):
+        OLLAMA_PROMPT_TOKENS.inc(result["prompt_eval_count"], model=model)
+    if eval_duration:
+        OLLAMA_EVAL_SECONDS.observe(eval_duration / 1e9, model=model)
+        if eval_count:
+            OLLAMA_TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9), model=model)
+    if result.get("prompt_eval_duration"):
+        OLLAMA_PROMPT_EVAL_SECONDS.observe(result["prompt_eval_duration"] / 1e9, model=model)
+
+class OllamaClient:
+    """Shared keep-alive HTTP client for the Ollama API.
+
+    A single requests.Session with a pooled adapter is reused by all worker threads,
+    so upstream calls skip the TCP handshake. Only failed connection attempts are
+    retried (with backoff): a read timeout means Ollama is busy or stuck, and sending
+    the same request again would just pile more work on it.
+    """
+
+    def __init__(self, base_url, pool_size=10, retries=2, backoff=0.5,
+                 connect_timeout=5, read_timeout=60, poll_timeout=10, pull_timeout=600):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.poll_timeout = poll_timeout
+        self.pull_timeout = pull_timeout
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            redirect=0,
+            backoff_factor=backoff,
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def _send(self, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+        except requests.RequestException:
+            UPSTREAM_REQUESTS.inc(path=path, status="error")
+            raise
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, path=path)
+        UPSTREAM_REQUESTS.inc(path=path, status=response.status_code)
+        return response
+
+    def get(self, path, timeout=None):
+        read_timeout = timeout if timeout is not None else self.poll_timeout
+        return self._send('GET', path, timeout=(self.connect_timeout, read_timeout))
+
+    def post(self, path, payload, timeout=None, stream=False):
+        read_timeout = timeout if timeout is not None else self.read_timeout
+        return self._send('POST', path, data=json_dumps(payload), headers=JSON_HEADERS, stream=stream,
+                          timeout=(self.connect_timeout, read_timeout))
+
+    def close(self):
+        self.session.close()
+
+class Backend(OllamaClient):
+    """One Ollama server behind the router, with its load and health bookkeeping.
+
+    Connection failures count against the backend; after max_failures in a row it
+    is ejected for eject_seconds, then gets traffic again on probation (one more
+    failure ejects it again). Any successful call resets the count.
+    """
+
+    def __init__(self, base_url, max_failures=3, eject_seconds=30, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.name = self.base_url
+        # What it was built with, so a config reload can tell whether to replace it
+        self.settings = {"max_failures": max_failures, "eject_seconds": eject_seconds, **kwargs}
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.in_flight = 0
+        self.model_in_flight = {}  # model -> requests in flight for it
+        self.dispatched = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.retired = False
+
+    def _send(self, method, path, **kwargs):
+        try:
+            response = super()._send(method, path, **kwargs)
+        except requests.ConnectionError:
+            self.record_failure()
+            raise
+        self.record_success()
+        return response
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+    def record_success(self):
+        if self.ejected_until:
+            logger.info("Backend %s is reachable again", self.name)
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if self.healthy:
+                logger.warning("Ejecting backend %s for %ss after %s failures", self.name, self.eject_seconds, self.failures)
+            self.ejected_until = time.monotonic() + self.eject_seconds
+
+    def running_models(self, refresh=False):
+        models = model_cache.get(('ps', self.name), functools.partial(_fetch_running_models, self), refresh=refresh)
+        return list(models) if models is not None else []
+
+    def available_models(self, refresh=False):
+        models = model_cache.get(('tags', self.name), functools.partial(_fetch_available_models, self), refresh=refresh)
+        return list(models) if models is not None else []
+
+    def poll_running(self):
+        """Fresh /api/ps model list; None if the backend could not be reached."""
+        return model_cache.get(('ps', self.name), functools.partial(_fetch_running_models, self), refresh=True)
+
+    def invalidate(self):
+        model_cache.invalidate(('ps', self.name))
+
+    def stats(self, refresh=False):
+        return {
+            "backend": self.name,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "dispatched": self.dispatched,
+            "failures": self.failures,
+            "running_models": self.running_models(refresh=refresh)
+        }
+
+class BackendLease:
+    """A request's hold on a backend; release() (or leaving the with block) frees it."""
+
+    def __init__(self, router, backend, model):
+        self.router = router
+        self.backend = backend
+        self.model = model
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.router._release(self.backend, self.model)
+
+    def __enter__(self):
+        return self.backend
+
+    def __exit__(self, *exc):
+        self.release()
+
+class BackendRouter:
+    """Spreads model traffic over one or more Ollama backends.
+
+    A request goes to a healthy backend that has the model, preferring one where
+    it is already loaded (per /api/ps) and then the one with the fewest requests in
+    flight. A backend already running slots_for(model) requests for the model is
+    only used when every other one is too, so a warm backend cannot take all the
+    traffic. A user sticks to the backend it last used for a model while that is
+    still a good choice, so Ollama can reuse the conversation's prompt cache.
+    With several backends a health check thread polls each /api/ps, which also
+    brings ejected backends back and keeps the warm-model view fresh.
+    """
+
+    def __init__(self, backends, pin_ttl=1800, max_pins=100000, slots_for=None):
+        self.backends = backends
+        self.slots_for = slots_for
+        self._by_name = {backend.name: backend for backend in backends}
+        self.pin_ttl = pin_ttl
+        self.max_pins = max_pins
+        self._pins = OrderedDict()  # (user_id, model) -> (backend name, expires at)
+        self._lock = threading.Lock()
+        self.health_interval = 0
+        self._health_thread = None
+
+    def set_backends(self, backends, pin_ttl=None):
+        """Swaps in a new backend list; dropped backends are closed once their last request finishes."""
+        with self._lock:
+            retired = [backend for backend in self.backends if backend not in backends]
+            self.backends = backends
+            self._by_name = {backend.name: backend for backend in backends}
+            if pin_ttl is not None:
+                self.pin_ttl = pin_ttl
+            for backend in retired:
+                backend.retired = True
+                if not backend.in_flight:
+                    backend.close()
+        return retired
+
+    def get(self, name):
+        backend = self._by_name.get(name.rstrip('/')) if isinstance(name, str) else None
+        if backend is None:
+            raise ApiError(f"Unknown backend {name}")
+        return backend
+
+    def candidates(self):
+        # With every backend ejected, trying one beats failing outright
+        return [backend for backend in self.backends if backend.healthy] or list(self.backends)
+
+    def _pinned(self, user_id, model):
+        with self._lock:
+            entry = self._pins.get((user_id, model))
+            if entry and entry[1] > time.monotonic():
+                return self._by_name.get(entry[0])
+            return None
+
+    def _options(self, model, user_id):
+        # The model lists may go to Ollama, so they are gathered outside the lock
+        candidates = self.candidates()
+        having = [backend for backend in candidates if model in backend.available_models()] or candidates
+        warm = [backend for backend in having if model in backend.running_models()]
+        pinned = self._pinned(user_id, model) if user_id else None
+        return having, warm, pinned
+
+    def _pick(self, model, having, warm, pinned):
+        slots = self.slots_for(model) if self.slots_for else None
+        if slots:
+            having = [backend for backend in having if backend.model_in_flight.get(model, 0) < slots] or having
+            warm = [backend for backend in warm if backend in having]
+        if pinned in having and (pinned in warm or not warm):
+            return pinned
+        return min(warm or having, key=lambda backend: (backend.in_flight, backend.dispatched))
+
+    def choose(self, model, user_id=None):
+        if len(self.backends) == 1:
+            return self.backends[0]
+        options = self._options(model, user_id)
+        with self._lock:
+            return self._pick(model, *options)
+
+    def acquire(self, model, user_id=None):
+        """Picks a backend for model and counts the request against it until the lease is released."""
+        backends = self.backends
+        options = self._options(model, user_id) if len(backends) > 1 else None
+        with self._lock:
+            # Picked under the lock so concurrent requests see each other's slots
+            backend = self._pick(model, *options) if options else backends[0]
+            backend.in_flight += 1
+            backend.model_in_flight[model] = backend.model_in_flight.get(model, 0) + 1
+            backend.dispatched += 1
+            if user_id and len(self.backends) > 1:
+                self._pins[(user_id, model)] = (backend.name, time.monotonic() + self.pin_ttl)
+                self._pins.move_to_end((user_id, model))
+                while len(self._pins) > self.max_pins:
+                    self._pins.popitem(last=False)
+        return BackendLease(self, backend, model)
+
+    def _release(self, backend, model):
+        with self._lock:
+            backend.in_flight -= 1
+            count = backend.model_in_flight.get(model, 0) - 1
+            if count > 0:
+                backend.model_in_flight[model] = count
+            else:
+                backend.model_in_flight.pop(model, None)
+            if backend.retired and not backend.in_flight:
+                backend.close()
+
+    def stats(self, refresh=False):
+        return [backend.stats(refresh=refresh) for backend in self.backends]
+
+    def start_health_checks(self, interval):
+        self.health_interval = interval
+        if interval <= 0 or self._health_thread is not None:
+            return
+        self._health_thread = threading.Thread(target=self._check_health, name="backend-health", daemon=True)
+        self._health_thread.start()
+
+    def _check_health(self):
+        while True:
+            # Re-read every round: a config reload can change the interval or the backends
+            time.sleep(self.health_interval if self.health_interval > 0 else 60)
+            backends = self.backends
+            if self.health_interval <= 0 or len(backends) < 2:
+                continue
+            for backend in backends:
+                # Failures are recorded by the backend itself
+                backend.poll_running()
+
+# Backends are added by configure_router() once config.json has been read
+# Looked up at call time: the scheduler settings are defined further down
+router = BackendRouter([], slots_for=lambda model: backend_slots(model))
+
+def backend_settings():
+    return {
+        "max_failures": config.get('backend_max_failures', 3),
+        "eject_seconds": config.get('backend_eject_seconds', 30),
+        "pool_size": config.get('ollama_pool_size', 10),
+        "retries": config.get('ollama_retries', 2),
+        "backoff": config.get('ollama_retry_backoff', 0.5),
+        "connect_timeout": config.get('ollama_connect_timeout', 5),
+        "read_timeout": config.get('ollama_read_timeout', 60),
+        "poll_timeout": config.get('ollama_poll_timeout', 10),
+        "pull_timeout": config.get('ollama_pull_timeout', 600)
+    }
+
+def configure_router():
+    """Points the router at ollama_server (one URL or a list of them).
+
+    A backend whose URL and client settings are unchanged is kept, with its
+    connection pool, health and load; the others are replaced.
+    """
+    servers = OLLAMA_SERVER if isinstance(OLLAMA_SERVER, list) else [OLLAMA_SERVER]
+    settings = backend_settings()
+    backends = []
+    for url in servers:
+        backend = router._by_name.get(url.rstrip('/'))
+        if backend is None or backend.settings != settings:
+            backend = Backend(url, **settings)
+        backends.append(backend)
+    retired = router.set_backends(backends, pin_ttl=config.get('backend_pin_ttl', 1800))
+    for backend in retired:
+        backend.invalidate()
+        logger.info("Backend %s retired", backend.name)
+    return retired
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Routes request.json and jsonify through the module's JSON codec."""
+
+    def dumps(self, obj, **kwargs):
+        if "indent" in kwargs:
+            return super().dumps(obj, **kwargs)
+        return json_dumps(obj, sort_keys=kwargs.get("sort_keys", False)).decode()
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        # Encode straight to bytes, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps(obj) + b"\n", mimetype=self.mimetype)
+
+# Routes are registered on a blueprint; create_app() builds the Flask app around it
+api = Blueprint('api', __name__)
+
+class Database:
+    """Per-thread SQLite connections for the context database.
+
+    Each thread opens one connection on first use and reuses it until the thread
+    exits, when the connection is closed. Connections run in WAL mode, so readers never wait behind a writer, and
+    concurrent writers wait out the busy timeout instead of failing with
+    "database is locked".
+    """
+
+    def __init__(self, path, busy_timeout=5, cached_statements=128):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        # Weak, so a connection goes away with the thread that opened it
+        self._holders = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False
+        )
+        # Lets maintenance hand free pages back; only takes effect on a new, empty file
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        return conn
+
+    def connection(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = _ConnectionHolder(self._open())
+            self._local.holder = holder
+            with self._lock:
+                self._holders.add(holder)
+        return holder.conn
+
+    def close_all(self):
+        with self._lock:
+            holders = list(self._holders)
+            self._holders = weakref.WeakSet()
+        for holder in holders:
+            holder.close()
+        self._local = threading.local()
+
+class _ConnectionHolder:
+    """Owns one thread's connection; the thread-local drops it when the thread exits,
+    and the finalizer then closes the connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._finalizer = weakref.finalize(self, _close_connection, conn)
+
+    def close(self):
+        self._finalizer()
+
+def _close_connection(conn):
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning("Failed to close database connection: %s", e)
+
+db = None
+
+# Initialize SQLite database for contexts and loaded model
+def init_db():
+    global db
+    try:
+        # Check if database file is accessible
+        if not os.path.exists(db_path):
+            logger.info("Database file %s does not exist; creating...", db_path)
+        elif not os.access(db_path, os.R_OK | os.W_OK):
+            logger.error("Database file %s exists but is not readable/writable", db_path)
+            raise PermissionError(f"Database file {db_path} is not accessible")
+
+        db = Database(
+            db_path,
+            busy_timeout=config.get('db_busy_timeout', 5),
+            cached_statements=config.get('db_statement_cache', 128)
+        )
+        conn = db.connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_user_seq ON messages (user_id, seq)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                user_id TEXT PRIMARY KEY,
+                upto_seq INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE TABLE IF NOT EXISTS loaded_model (id INTEGER PRIMARY KEY CHECK (id = 1), name TEXT)")
+        migrate_context_blobs(conn)
+        logger.info("Database initialized successfully")
+    except Exception as e:
+        logger.error("Failed to initialize database: %s", e)
+        raise
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for budgeting."""
+    return max(1, (len(text) + 3) // 4)
+
+# One-time migration from the old one-JSON-blob-per-user contexts table
+def migrate_context_blobs(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'contexts'").fetchone()
+    if not exists:
+        return
+    logger.info("Migrating stored contexts to per-message rows")
+    migrated = 0
+    now = time.time()
+    with conn:
+        for user_id, blob in conn.execute("SELECT user_id, context FROM contexts").fetchall():
+            # One bad row must not stop the API from starting: skip it and carry on
+            try:
+                history = json_loads(blob) if blob else []
+                if not isinstance(history, list):
+                    raise TypeError(f"expected a list of messages, got {type(history).__name__}")
+                rows = []
+                for m in history:
+                    if not isinstance(m, dict) or not isinstance(m.get("content", ""), str):
+                        logger.warning("Skipping malformed message in context for user %s: %s", user_id, Truncated(m))
+                        continue
+                    content = m.get("content", "")
+                    rows.append((user_id, len(rows) + 1, str(m.get("role", "user")), content,
+                                 estimate_tokens(content), now))
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.warning("Skipping unreadable context for user %s: %s", user_id, e)
+                continue
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages (user_id, seq, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            migrated += 1
+        conn.execute("DROP TABLE contexts")
+    logger.info("Migrated contexts for %s users", migrated)
+
+APPEND_MESSAGE_SQL = (
+    "INSERT INTO messages (user_id, seq, role, content, tokens, created_at) "
+    "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE user_id = ?), ?, ?, ?, ?)"
+)
+
+def message_rows(turns):
+    """Flattens (user_id, new_messages) pairs into rows for write_messages()."""
+    now = time.time()
+    return [(user_id, m["role"], m["content"], estimate_tokens(m["content"]), now)
+            for user_id, new_messages in turns for m in new_messages]
+
+def write_messages(rows):
+    """Appends (user_id, role, content, tokens, created_at) rows in one transaction, in order."""
+    conn = db.connection()
+    with conn:
+        conn.executemany(
+            APPEND_MESSAGE_SQL,
+            [(user_id, user_id, role, content, tokens, created_at) for user_id, role, content, tokens, created_at in rows]
+        )
+
+def save_context(user_id, new_messages):
+    """Appends new_messages to the user's stored history."""
+    if context_cache is not None:
+        context_cache.append(message_rows([(user_id, new_messages)]))
+        return
+    try:
+        with timed_db('save_context'):
+            write_messages(message_rows([(user_id, new_messages)]))
+        logger.debug("Saved %s messages for user %s", len(new_messages), user_id)
+    except Exception as e:
+        logger.error("Failed to save context for user %s: %s", user_id, e)
+
+def save_contexts(turns):
+    """Appends several (user_id, new_messages) pairs in a single transaction."""
+    if context_cache is not None:
+        context_cache.append(message_rows(turns))
+        return
+    try:
+        with timed_db('save_contexts'):
+            write_messages(message_rows(turns))
+        logger.debug("Saved %s turns in one transaction", len(turns))
+    except Exception as e:
+        logger.error("Failed to save contexts for %s turns: %s", len(turns), e)
+
+@db_timed('load_context')
+def load_context_rows(user_id, after_seq=0):
+    """Returns (seq, role, content, tokens) rows newer than after_seq, oldest first."""
+    try:
+        return db.connection().execute(
+            "SELECT seq, role, content, tokens FROM messages WHERE user_id = ? AND seq > ? ORDER BY seq",
+            (user_id, after_seq)).fetchall()
+    except Exception as e:
+        logger.error("Failed to load context rows for user %s: %s", user_id, e)
+        return []
+
+def read_contexts(user_ids):
+    """Reads the stored summary and unsummarized rows for many users at once.
+
+    Returns {user_id: (summary, rows)} with summary as load_summary() returns it
+    and rows as load_context_rows() does for the messages after the summary.
+    """
+    contexts = {user_id: (None, []) for user_id in user_ids}
+    user_ids = list(contexts)
+    conn = db.connection()
+    # Stay well under SQLite's limit on bound parameters per statement
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        marks = ", ".join("?" * len(chunk))
+        for user_id, upto_seq, content, tokens in conn.execute(
+                f"SELECT user_id, upto_seq, content, tokens FROM summaries WHERE user_id IN ({marks})", chunk):
+            contexts[user_id] = ((upto_seq, content, tokens), [])
+        for user_id, seq, role, content, tokens in conn.execute(
+                "SELECT m.user_id, m.seq, m.role, m.content, m.tokens FROM messages m "
+                "LEFT JOIN summaries s ON s.user_id = m.user_id "
+                f"WHERE m.user_id IN ({marks}) AND m.seq > COALESCE(s.upto_seq, 0) "
+                "ORDER BY m.user_id, m.seq", chunk):
+            contexts[user_id][1].append((seq, role, content, tokens))
+    return contexts
+
+def read_last_seqs(user_ids):
+    """Returns {user_id: seq of their newest stored message, or 0}."""
+    last = dict.fromkeys(user_ids, 0)
+    user_ids = list(last)
+    conn = db.connection()
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        marks = ", ".join("?" * len(chunk))
+        last.update(conn.execute(
+            f"SELECT user_id, MAX(seq) FROM messages WHERE user_id IN ({marks}) GROUP BY user_id", chunk))
+    return last
+
+def load_contexts(user_ids):
+    """read_contexts() for many users, served from the context cache where possible."""
+    try:
+        if context_cache is not None:
+            return context_cache.get_many(user_ids)
+        with timed_db('load_contexts'):
+            return read_contexts(user_ids)
+    except Exception as e:
+        logger.error("Failed to load contexts for %s users: %s", len(user_ids), e)
+        return {user_id: (None, []) for user_id in user_ids}
+
+def load_history(user_id):
+    """The user's (summary, rows), from the context cache when it is enabled."""
+    if context_cache is None:
+        summary = load_summary(user_id)
+        return summary, load_context_rows(user_id, after_seq=summary[0] if summary else 0)
+    try:
+        return context_cache.get_many([user_id])[user_id]
+    except Exception as e:
+        logger.error("Failed to load context for user %s: %s", user_id, e)
+        return None, []
+
+@db_timed('load_summary')
+def load_summary(user_id):
+    try:
+        return db.connection().execute(
+            "SELECT upto_seq, content, tokens FROM summaries WHERE user_id = ?", (user_id,)).fetchone()
+    except Exception as e:
+        logger.error("Failed to load summary for user %s: %s", user_id, e)
+        return None
+
+@db_timed('save_summary')
+def save_summary(user_id, upto_seq, content):
+    try:
+        conn = db.connection()
+        with conn:
+            # Never replace a summary with one that covers less history
+            conn.execute(
+                "INSERT INTO summaries (user_id, upto_seq, content, tokens, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET upto_seq = excluded.upto_seq, content = excluded.content, "
+                "tokens = excluded.tokens, updated_at = excluded.updated_at WHERE excluded.upto_seq > summaries.upto_seq",
+                (user_id, upto_seq, content, estimate_tokens(content), time.time())
+            )
+        if context_cache is not None:
+            context_cache.note_summary(user_id, upto_seq, content)
+        logger.debug("Saved summary for user %s up to message %s", user_id, upto_seq)
+    except Exception as e:
+        logger.error("Failed to save summary for user %s: %s", user_id, e)
+
+class CachedContext:
+    """One user's summary and unsummarized rows as held by the ContextCache."""
+
+    __slots__ = ('summary', 'rows', 'size')
+
+    # Rough per-row cost of the tuple and its strings beyond the content itself
+    ROW_OVERHEAD = 120
+
+    def __init__(self, summary, rows):
+        self.summary = summary
+        self.rows = list(rows)
+        self.size = (len(summary[1]) if summary else 0) + sum(len(row[2]) + self.ROW_OVERHEAD for row in self.rows)
+
+    @property
+    def last_seq(self):
+        if self.rows:
+            return self.rows[-1][0]
+        return self.summary[0] if self.summary else 0
+
+    def add(self, role, content, tokens):
+        self.rows.append((self.last_seq + 1, role, content, tokens))
+        self.size += len(content) + self.ROW_OVERHEAD
+
+class ContextCache:
+    """LRU of recent user contexts in front of SQLite, with write-behind saves.
+
+    Reads are served from memory while the user's entry stays within max_bytes;
+    a miss loads from SQLite. New messages update the cached entry straight away
+    and are queued for a background thread that writes them in batches: as soon
+    as flush_batch rows are waiting, and never later than max_delay seconds after
+    the oldest was queued. Loads first flush any rows still queued for the user,
+    and a load that raced with a write for the same user is returned but not
+    cached, so a cached entry never misses a message.
+
+    Entries assume this process is the only writer for its users. After each
+    flush the sequence numbers SQLite assigned are compared with the cached ones,
+    and an entry that another process wrote to is dropped and reloaded.
+    """
+
+    def __init__(self, max_bytes, max_delay=1.0, flush_batch=500):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.flush_batch = max(1, flush_batch)
+        self._entries = OrderedDict()  # user_id -> CachedContext
+        self._bytes = 0
+        self._pending = deque()  # (user_id, role, content, tokens, created_at) not yet in SQLite
+        self._dirty = {}  # user_id -> rows of theirs in _pending or being flushed
+        self._loads = {}  # user_id -> [loads in progress, writes seen meanwhile]
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.foreign_writes = 0
+        self.last_flush_lag = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="context-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0][4] + self.max_delay
+                while self._pending and len(self._pending) < self.flush_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Failed to flush queued context writes: %s", e)
+                time.sleep(self.max_delay)
+
+    def _touch(self, user_id):
+        load = self._loads.get(user_id)
+        if load is not None:
+            load[1] += 1
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def get_many(self, user_ids):
+        """Returns {user_id: (summary, rows)} like read_contexts(); rows are copies."""
+        found = {}
+        missing = []
+        with self._cond:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    missing.append(user_id)
+                    continue
+                self._entries.move_to_end(user_id)
+                found[user_id] = (entry.summary, list(entry.rows))
+            self.hits += len(found)
+            self.misses += len(missing)
+            if not missing:
+                return found
+            needs_flush = any(user_id in self._dirty for user_id in missing)
+            seen = {}
+            for user_id in missing:
+                load = self._loads.setdefault(user_id, [0, 0])
+                load[0] += 1
+                seen[user_id] = load[1]
+
+        loaded = None
+        try:
+            if needs_flush:
+                self.flush()
+            with timed_db('load_contexts'):
+                loaded = read_contexts(missing)
+        finally:
+            with self._cond:
+                for user_id in missing:
+                    load = self._loads[user_id]
+                    load[0] -= 1
+                    if loaded is not None and load[1] == seen[user_id] and user_id not in self._entries:
+                        entry = CachedContext(*loaded[user_id])
+                        self._entries[user_id] = entry
+                        self._bytes += entry.size
+                    if not load[0]:
+                        del self._loads[user_id]
+                self._evict()
+        for user_id in missing:
+            summary, rows = loaded[user_id]
+            found[user_id] = (summary, list(rows))
+        return found
+
+    def append(self, rows):
+        """Adds (user_id, role, content, tokens, created_at) rows to the cache and the write queue."""
+        with self._cond:
+            for user_id, role, content, tokens, _ in rows:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    size = entry.size
+                    entry.add(role, content, tokens)
+                    self._bytes += entry.size - size
+                self._dirty[user_id] = self._dirty.get(user_id, 0) + 1
+                self._touch(user_id)
+            was_idle = not self._pending
+            self._pending.extend(rows)
+            self._evict()
+            if was_idle or len(self._pending) >= self.flush_batch:
+                self._cond.notify()
+
+    def note_summary(self, user_id, upto_seq, content):
+        """Mirrors a saved summary: rows it covers leave the cached entry."""
+        with self._cond:
+            self._touch(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None or (entry.summary and entry.summary[0] >= upto_seq):
+                return
+            self._drop(user_id)
+            entry = CachedContext((upto_seq, content, estimate_tokens(content)),
+                                  [row for row in entry.rows if row[0] > upto_seq])
+            self._entries[user_id] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def invalidate(self, user_id):
+        """Forgets a user's cached entry, e.g. after maintenance deleted their rows."""
+        with self._cond:
+            self._touch(user_id)
+            self._drop(user_id)
+
+    def flush(self):
+        """Writes every queued row to SQLite in one transaction and returns how many."""
+        with self._flush_lock:
+            with self._cond:
+                rows = list(self._pending)
+                self._pending.clear()
+            if not rows:
+                return 0
+            try:
+                with timed_db('flush_contexts'):
+                    write_messages(rows)
+            except Exception:
+                with self._cond:
+                    self._pending.extendleft(reversed(rows))
+                raise
+            stored = read_last_seqs({row[0] for row in rows})
+            with self._cond:
+                for row in rows:
+                    count = self._dirty[row[0]] - 1
+                    if count:
+                        self._dirty[row[0]] = count
+                    else:
+                        del self._dirty[row[0]]
+                for user_id, last_seq in stored.items():
+                    entry = self._entries.get(user_id)
+                    # Rows still queued for the user are cached but not yet in SQLite
+                    if entry is not None and entry.last_seq - self._dirty.get(user_id, 0) != last_seq:
+                        logger.warning("Context of user %s was changed by another process; reloading it", user_id)
+                        self._touch(user_id)
+                        self._drop(user_id)
+                        self.foreign_writes += 1
+                self.flushes += 1
+                self.flushed_rows += len(rows)
+                self.last_flush_lag = time.time() - rows[0][4]
+            logger.debug("Flushed %s queued context rows", len(rows))
+            return len(rows)
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Failed to flush queued context writes at exit: %s", e)
+
+    def stats(self):
+        with self._cond:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "pending_rows": len(self._pending),
+                "flush_lag": round(time.time() - self._pending[0][4], 3) if self._pending else 0.0,
+                "last_flush_lag": round(self.last_flush_lag, 3),
+                "flushes": self.flushes,
+                "flushed_rows": self.flushed_rows,
+                "foreign_writes": self.foreign_writes
+            }
+
+context_cache = None
+
+def init_context_cache():
+    """Creates the context cache, or applies new limits to the running one on a config reload."""
+    global context_cache
+    enabled = CONTEXT_CACHE.get('enabled', False)
+    if context_cache is not None:
+        if not enabled:
+            logger.warning("Disabling the context cache takes effect after a restart")
+            return
+        with context_cache._cond:
+            context_cache.max_bytes = CONTEXT_CACHE.get('max_bytes', 67108864)
+            context_cache.max_delay = CONTEXT_CACHE.get('max_delay', 1.0)
+            context_cache.flush_batch = CONTEXT_CACHE.get('flush_batch', 500)
+            context_cache._evict()
+            context_cache._cond.notify_all()
+        return
+    if not enabled:
+        return
+    context_cache = ContextCache(
+        CONTEXT_CACHE.get('max_bytes', 67108864),
+        max_delay=CONTEXT_CACHE.get('max_delay', 1.0),
+        flush_batch=CONTEXT_CACHE.get('flush_batch', 500)
+    )
+    context_cache.start()
+    atexit.register(context_cache.close)
+    logger.info("Context cache enabled (%s bytes, writes flushed within %ss)",
+                context_cache.max_bytes, context_cache.max_delay)
+
+DB_MAINTENANCE_DELETED = Counter('db_maintenance_deleted_total', 'Messages removed by database maintenance', ('reason',))
+
+class DbMaintenance:
+    """Background upkeep for the context database.
+
+    Every interval seconds it deletes the history of users idle for longer than
+    context_ttl, trims each user to their newest max_messages, returns up to
+    vacuum_pages free pages to the filesystem and refreshes the query planner's
+    statistics. Each delete transaction removes at most batch_size rows, so a /chat
+    write never waits behind more than one short batch. A setting of 0 turns the
+    matching step off; expiry and the history cap are off unless configured.
+    """
+
+    def __init__(self, database, interval=3600, context_ttl=0, max_messages=0, batch_size=500,
+                 vacuum_pages=0, analyze=True):
+        self.db = database
+        self.interval = interval
+        self.context_ttl = context_ttl
+        self.max_messages = max_messages
+        self.batch_size = max(1, batch_size)
+        self.vacuum_pages = vacuum_pages
+        self.analyze = analyze
+        self.last_run = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="db-maintenance", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            # interval can drop to 0 on a config reload; idle until it is turned back on
+            if self.interval <= 0:
+                time.sleep(60)
+                continue
+            try:
+                self.run()
+            except Exception as e:
+                logger.error("Database maintenance failed: %s", e)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _forget(user_id):
+        if context_cache is not None:
+            context_cache.invalidate(user_id)
+
+    def _delete_oldest(self, conn, user_id, limit):
+        # Deletes go through the id of at most batch_size rows, so one transaction
+        # never touches more than that however long the history is
+        return conn.execute(
+            "DELETE FROM messages WHERE id IN "
+            "(SELECT id FROM messages WHERE user_id = ? ORDER BY seq LIMIT ?)",
+            (user_id, limit)
+        ).rowcount
+
+    def expire_idle(self, conn, now):
+        """Deletes messages and summaries of users whose last message is older than context_ttl."""
+        cutoff = now - self.context_ttl
+        # The newest message per user is found through the (user_id, seq) index
+        idle = [row[0] for row in conn.execute(
+            "SELECT m.user_id FROM (SELECT user_id, MAX(seq) AS seq FROM messages GROUP BY user_id) AS last "
+            "JOIN messages AS m ON m.user_id = last.user_id AND m.seq = last.seq WHERE m.created_at < ?",
+            (cutoff,))]
+        users = deleted = 0
+        for user_id in idle:
+            while True:
+                with timed_db('expire_contexts'), conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    # Check again under the write lock: the user may have come back since the scan
+                    last = conn.execute(
+                        "SELECT created_at FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT 1", (user_id,)).fetchone()
+                    if last is not None and last[0] >= cutoff:
+                        break
+                    count = self._delete_oldest(conn, user_id, self.batch_size)
+                    deleted += count
+                    if count < self.batch_size:
+                        conn.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+                        users += 1
+                        break
+            self._forget(user_id)
+        DB_MAINTENANCE_DELETED.inc(deleted, reason="expired")
+        return users, deleted
+
+    def cap_history(self, conn):
+        """Keeps only the newest max_messages messages of each user."""
+        over = conn.execute(
+            "SELECT user_id, COUNT(*) FROM messages GROUP BY user_id HAVING COUNT(*) > ?",
+            (self.max_messages,)).fetchall()
+        deleted = 0
+        for user_id, count in over:
+            excess = count - self.max_messages
+            while excess > 0:
+                # Oldest first, so messages written since the scan are never the ones removed
+                with timed_db('cap_contexts'), conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    removed = self._delete_oldest(conn, user_id, min(excess, self.batch_size))
+                deleted += removed
+                if not removed:
+                    break
+                excess -= removed
+            self._forget(user_id)
+        DB_MAINTENANCE_DELETED.inc(deleted, reason="capped")
+        return len(over), deleted
+
+    def vacuum(self, conn):
+        """Frees up to vacuum_pages pages; a no-op unless the database uses auto_vacuum=INCREMENTAL."""
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        with timed_db('incremental_vacuum'):
+            # executescript steps the pragma to completion; execute() would free a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def run(self):
+        """Runs one maintenance pass and returns what it did."""
+        with self._lock:
+            started = time.time()
+            conn = self.db.connection()
+            result = {"started_at": started}
+            if context_cache is not None:
+                # Queued writes must be on disk before deciding who is idle
+                context_cache.flush()
+            if self.context_ttl > 0:
+                result["expired_users"], result["expired_messages"] = self.expire_idle(conn, started)
+            if self.max_messages > 0:
+                result["capped_users"], result["capped_messages"] = self.cap_history(conn)
+            if self.vacuum_pages > 0:
+                result["vacuumed_pages"] = self.vacuum(conn)
+            if self.analyze:
+                with timed_db('analyze'):
+                    conn.execute("PRAGMA analysis_limit=1000")
+                    conn.execute("ANALYZE")
+            # Let the WAL be reused instead of growing; PASSIVE never waits on writers
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            result["seconds"] = round(time.time() - started, 3)
+            self.last_run = result
+            logger.info("Database maintenance: %s", result)
+            return result
+
+db_maintenance = None
+
+def init_db_maintenance():
+    """Starts database maintenance, or applies new settings to the running task on a config reload."""
+    global db_maintenance
+    settings = dict(
+        interval=MAINTENANCE.get('interval', 3600),
+        context_ttl=MAINTENANCE.get('context_ttl', 0),
+        max_messages=MAINTENANCE.get('max_messages', 0),
+        batch_size=MAINTENANCE.get('batch_size', 500),
+        vacuum_pages=MAINTENANCE.get('vacuum_pages', 2000),
+        analyze=MAINTENANCE.get('analyze', True)
+    )
+    if db_maintenance is not None:
+        for name, value in settings.items():
+            setattr(db_maintenance, name, value)
+        db_maintenance.start()
+        return
+    db_maintenance = DbMaintenance(db, **settings)
+    if db_maintenance.vacuum_pages > 0 and db.connection().execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logger.info("Incremental vacuum is off for %s; run VACUUM once with auto_vacuum=INCREMENTAL to enable it", db_path)
+    db_maintenance.start()
+
+def db_stats(top=10):
+    """Size, row counts and largest contexts of the context database.
+
+    Only reads, which in WAL mode never hold up writers.
+    """
+    conn = db.connection()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    files = {}
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            files[os.path.basename(db_path) + suffix] = os.path.getsize(db_path + suffix)
+        except OSError:
+            pass
+    with timed_db('db_stats'):
+        messages, users = conn.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM messages").fetchone()
+        summaries = conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+        largest = conn.execute(
+            "SELECT user_id, COUNT(*), SUM(tokens), MAX(created_at) FROM messages "
+            "GROUP BY user_id ORDER BY SUM(tokens) DESC LIMIT ?", (max(0, min(top, 100)),)).fetchall()
+    return {
+        "path": db_path,
+        "file_bytes": files,
+        "page_size": page_size,
+        "page_count": page_count,
+        "free_pages": freelist,
+        "auto_vacuum": ("none", "full", "incremental")[conn.execute("PRAGMA auto_vacuum").fetchone()[0]],
+        "rows": {"messages": messages, "users": users, "summaries": summaries},
+        "largest_contexts": [
+            {"user_id": user_id, "messages": count, "tokens": tokens, "last_active": last_active}
+            for user_id, count, tokens, last_active in largest
+        ],
+        "maintenance": db_maintenance.last_run if db_maintenance else None,
+        "context_cache": context_cache.stats() if context_cache else None
+    }
+
+def check_admin_token(supplied):
+    """Raises unless supplied matches admin_token; admin routes are open when it is unset."""
+    if ADMIN_TOKEN and not hmac.compare_digest(str(supplied or ""), str(ADMIN_TOKEN)):
+        raise ApiError("Admin token required", 401, headers={"WWW-Authenticate": "Bearer"})
+
+def admin_token_from(authorization, header_token):
+    """The admin token from an Authorization: Bearer header or X-Admin-Token."""
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return header_token
+
+@db_timed('save_loaded_model')
+def save_loaded_model(model):
+    try:
+        conn = db.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO loaded_model (id, name) VALUES (1, ?)", (model,))
+        logger.debug("Saved loaded model: %s", model)
+    except Exception as e:
+        logger.error("Failed to save loaded model: %s", e)
+
+def get_loaded_model(refresh=False):
+    try:
+        with timed_db('get_loaded_model'):
+            result = db.connection().execute("SELECT name FROM loaded_model WHERE id = 1").fetchone()
+        model = result[0] if result else None
+        if model and not is_model_loaded(model, refresh=refresh):
+            save_loaded_model(None)
+            model = None
+        logger.debug("Retrieved loaded model: %s", model)
+        return model
+    except Exception as e:
+        logger.error("Failed to get loaded model: %s", e)
+        return None
+
+class ModelStateCache:
+    """In-process TTL cache for Ollama model state (/api/tags and /api/ps).
+
+    Refreshes are single-flight: concurrent callers for the same key wait on one
+    upstream call instead of each issuing their own. Failed fetches are not cached.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # key -> (fetch started at, value)
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _usable(self, entry, requested_at, refresh):
+        if entry is None:
+            return False
+        if refresh:
+            # Only a fetch that started after this caller asked is fresh enough
+            return entry[0] >= requested_at
+        return time.monotonic() - entry[0] < self.ttl
+
+    def get(self, key, fetch, refresh=False):
+        requested_at = time.monotonic()
+        entry = self._entries.get(key)
+        if self._usable(entry, requested_at, refresh):
+            return entry[1]
+        with self._lock_for(key):
+            # Another thread may have refreshed while we waited for the lock
+            entry = self._entries.get(key)
+            if self._usable(entry, requested_at, refresh):
+                return entry[1]
+            started_at = time.monotonic()
+            value = fetch()
+            if value is not None:
+                self._entries[key] = (started_at, value)
+            elif entry is not None and not refresh:
+                logger.warning("Refreshing %s failed; serving cached value", key)
+                return entry[1]
+            return value
+
+    def invalidate(self, *keys):
+        with self._guard:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+model_cache = ModelStateCache(MODEL_CACHE_TTL)
+
+# Fetch running models from a backend's /api/ps; None on failure
+def _fetch_running_models(backend):
+    try:
+        response = backend.get("/api/ps")
+        logger.debug("Ollama /api/ps response: %s - %s", response.status_code, Truncated(response.text))
+        if response.status_code != 200:
+            logger.error("Failed to check running models: %s - %s", response.status_code, Truncated(response.text))
+            return None
+        return [m['name'] for m in json_loads(response.content).get('models', [])]
+    except requests.Timeout:
+        logger.error("Timeout checking running models")
+        return None
+    except requests.RequestException as e:
+        logger.error("Network error checking running models: %s", e)
+        return None
+    except Exception as e:
+        logger.error("Error checking running models: %s", e)
+        return None
+
+# Fetch available models from a backend's /api/tags; None on failure
+def _fetch_available_models(backend):
+    try:
+        response = backend.get("/api/tags")
+        logger.debug("Ollama /api/tags response: %s - %s", response.status_code, Truncated(response.text))
+        if response.status_code == 200:
+            result = json_loads(response.content)
+            models = [model['name'] for model in result.get('models', [])]
+            logger.info("Polled %s models: %s", len(models), Truncated(models))
+            return models
+        else:
+            logger.error("Failed to poll models: %s - %s", response.status_code, Truncated(response.text))
+            return None
+    except requests.Timeout:
+        logger.error("Timeout polling Ollama models")
+        return None
+    except requests.RequestException as e:
+        logger.error("Network error polling Ollama models: %s", e)
+        return None
+    except Exception as e:
+        logger.error("Error polling Ollama models: %s", e)
+        return None
+
+def _merge_model_lists(lists):
+    merged = []
+    for models in lists:
+        merged += [model for model in models if model not in merged]
+    return merged
+
+# Running models across the healthy backends
+def get_running_models(refresh=False):
+    return _merge_model_lists(backend.running_models(refresh=refresh) for backend in router.candidates())
+
+# Check if a model is loaded (on backend, or on any healthy backend) using /api/ps
+def is_model_loaded(model, refresh=False, backend=None):
+    backends = [backend] if backend else router.candidates()
+    return any(model in b.running_models(refresh=refresh) for b in backends)
+
+# Poll Ollama for models available on any healthy backend
+def poll_ollama_models(refresh=False):
+    return _merge_model_lists(backend.available_models(refresh=refresh) for backend in router.candidates())
+
+# Whether model is running (on backend, or anywhere) per a fresh /api/ps poll; None if no backend could be reached
+def poll_model_running(model, backend=None):
+    polls = [b.poll_running() for b in ([backend] if backend else router.backends)]
+    reached = [running for running in polls if running is not None]
+    if not reached:
+        return None
+    return any(model in running for running in reached)
+
+def backoff_delays(initial=0.1, maximum=2.0):
+    """Exponential backoff schedule for readiness polling."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+def wait_for_model_state(model, loaded=True, timeout=None, backend=None):
+    """Polls /api/ps with exponential backoff until model is (or is no longer) running.
+
+    Only backend is polled if one is given; otherwise the model counts as running
+    while any backend lists it. Returns False if that state was not reached within
+    the timeout, which defaults to model_ready_timeout for loads and
+    model_unload_timeout for unloads.
+    """
+    if timeout is None:
+        timeout = MODEL_READY_TIMEOUT if loaded else MODEL_UNLOAD_TIMEOUT
+    deadline = time.monotonic() + timeout
+    for delay in backoff_delays():
+        if poll_model_running(model, backend) == loaded:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+
+# A chat with keep_alive=-1 leaves the model running; don't let a stale /api/ps view hide it
+def note_model_running(model, backend=None):
+    for b in ([backend] if backend else router.backends):
+        if not is_model_loaded(model, backend=b):
+            b.invalidate()
+
+def clean_response(response_text):
+    """Removes <think> tags and cleans up response."""
+    try:
+        response_text = re.sub(r"<think>.*?</think>", "", response_text, flags=re.DOTALL)
+        response_text = re.sub(r"<think>|</think>", "", response_text)
+        return response_text.strip()
+    except Exception as e:
+        logger.error("Error cleaning response: %s", e)
+        return response_text
+
+class ThinkStripper:
+    """Incremental counterpart of clean_response for streamed chunks.
+
+    Tags may be split across chunk boundaries, so any trailing text that could
+    still turn into a tag is held back until the next chunk (or flush) decides it.
+    Leading and trailing whitespace is dropped the same way clean_response strips it.
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._thinking = None  # text seen inside an unclosed <think>, or None
+        self._pending_ws = ""
+        self._started = False
+
+    @staticmethod
+    def _partial_tag_len(text):
+        # Length of the longest suffix of text that is a prefix of either tag
+        for size in range(min(len(text), len(ThinkStripper.CLOSE) - 1), 0, -1):
+            tail = text[-size:]
+            if ThinkStripper.OPEN.startswith(tail) or ThinkStripper.CLOSE.startswith(tail):
+                return size
+        return 0
+
+    def _emit(self, text):
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+        text = self._pending_ws + text
+        visible = text.rstrip()
+        self._pending_ws = text[len(visible):]
+        return visible
+
+    def feed(self, chunk):
+        """Consumes a chunk of raw model output and returns the text safe to show."""
+        self._buffer += chunk
+        out = []
+        while self._buffer:
+            if self._thinking is not None:
+                idx = self._buffer.find(self.CLOSE)
+                if idx != -1:
+                    self._buffer = self._buffer[idx + len(self.CLOSE):]
+                    self._thinking = None
+                    continue
+                hold = self._partial_tag_len(self._buffer)
+                self._thinking += self._buffer[:len(self._buffer) - hold]
+                self._buffer = self._buffer[len(self._buffer) - hold:]
+                break
+
+            open_idx = self._buffer.find(self.OPEN)
+            close_idx = self._buffer.find(self.CLOSE)
+            if close_idx != -1 and (open_idx == -1 or close_idx < open_idx):
+                # Stray closing tag outside a think span
+                out.append(self._buffer[:close_idx])
+                self._buffer = self._buffer[close_idx + len(self.CLOSE):]
+            elif open_idx != -1:
+                out.append(self._buffer[:open_idx])
+                self._buffer = self._buffer[open_idx + len(self.OPEN):]
+                self._thinking = ""
+            else:
+                hold = self._partial_tag_len(self._buffer)
+                out.append(self._buffer[:len(self._buffer) - hold])
+                self._buffer = self._buffer[len(self._buffer) - hold:]
+                break
+        return self._emit("".join(out))
+
+    def flush(self):
+        """Returns whatever is still held back once the stream has ended."""
+        if self._thinking is not None:
+            # Unclosed <think>: like clean_response, keep the text and drop the tag
+            remaining = (self._thinking + self._buffer).replace(self.OPEN, "")
+        else:
+            remaining = self._buffer
+        self._buffer = ""
+        self._thinking = None
+        text = self._emit(remaining)
+        self._pending_ws = ""
+        return text
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep names, facts, decisions "
+    "and open questions that later replies may depend on. Reply with the summary only."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+# Settings for a model from a config section: its "models" entry (full name, then base name) over "default"
+def per_model_config(section, model, defaults):
+    settings = dict(defaults)
+    settings.update(section.get('default', {}))
+    overrides = section.get('models', {})
+    settings.update(overrides.get(model) or overrides.get(model.split(':')[0]) or {})
+    return settings
+
+def context_window_for(model):
+    return per_model_config(CONTEXT_WINDOW, model, {
+        "max_tokens": 4096, "reserve_tokens": 1024, "summarize": False, "summary_model": None
+    })
+
+def assemble_context(user_id, model, user_input, history=None):
+    """Builds the history to send ahead of user_input within the model's token budget.
+
+    The newest turns are kept; older ones are trimmed and, when the model's window
+    has "summarize" enabled, folded into the stored summary in the background.
+    history is an already loaded (summary, rows) pair, as load_contexts() returns;
+    without it the user's context is read from the database.
+    Returns (messages, trimmed_tokens).
+    """
+    window = context_window_for(model)
+    summary, rows = history if history is not None else load_history(user_id)
+    budget = window['max_tokens'] - window['reserve_tokens'] - estimate_tokens(user_input)
+
+    prefix = []
+    if summary:
+        prefix = [{"role": "system", "content": SUMMARY_PREFIX + summary[1]}]
+        budget -= summary[2]
+
+    kept = []
+    used = 0
+    for row in reversed(rows):
+        if used + row[3] > budget:
+            break
+        kept.append(row)
+        used += row[3]
+    kept.reverse()
+    # Don't open the window on a reply whose question was trimmed
+    while kept and kept[0][1] == "assistant":
+        kept.pop(0)
+
+    evicted = rows[:len(rows) - len(kept)]
+    trimmed_tokens = sum(row[3] for row in evicted)
+    if evicted:
+        logger.info("Trimmed %s messages (%s tokens) from context for user %s", len(evicted), trimmed_tokens, user_id)
+        if window['summarize']:
+            schedule_summary(user_id, window['summary_model'] or model, summary, evicted)
+
+    return prefix + [{"role": role, "content": content} for _, role, content, _ in kept], trimmed_tokens
+
+def schedule_summary(user_id, model, summary, evicted):
+    with _summaries_lock:
+        if user_id in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(user_id)
+    threading.Thread(target=summarize_context, args=(user_id, model, summary, evicted), daemon=True).start()
+
+# Fold evicted turns (and any previous summary) into a new stored summary
+def summarize_context(user_id, model, summary, evicted):
+    try:
+        transcript = "\n".join(f"{role}: {clean_response(content)}" for _, role, content, _ in evicted)
+        if summary:
+            transcript = f"Earlier summary: {summary[1]}\n\n{transcript}"
+        ticket = scheduler.acquire(model, "__summary__")
+        try:
+            with router.acquire(model, user_id) as backend:
+                response = backend.post(
+                    "/api/chat",
+                    {
+                        "model": model,
+                        "messages": [
+                            {"role": "system", "content": SUMMARY_PROMPT},
+                            {"role": "user", "content": transcript}
+                        ],
+                        "stream": False,
+                        "keep_alive": -1
+                    }
+                )
+        finally:
+            scheduler.release(ticket)
+        if response.status_code != 200:
+            logger.error("Summary request failed for user %s: %s - %s", user_id, response.status_code, Truncated(response.text))
+            return
+        content = clean_response(json_loads(response.content).get("message", {}).get("content", ""))
+        if content:
+            save_summary(user_id, evicted[-1][0], content)
+    except Exception as e:
+        logger.error("Failed to summarize context for user %s: %s", user_id, e)
+    finally:
+        with _summaries_lock:
+            _summaries_in_flight.discard(user_id)
+
+class ApiError(Exception):
+    """An error that maps directly onto a JSON error response."""
+
+    def __init__(self, message, status=400, headers=None, **extra):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+        self.payload = {"error": message, **extra}
+
+class Schema:
+    """A JSON object schema compiled once into one check per field.
+
+    Fields map a JSON key to its options: "type" (accepted Python type or tuple,
+    None for anything), "key" (output name, defaults to the JSON key), "default"
+    (value or zero-argument callable used when the field is missing or null),
+    "required", "strip", "nonempty", "max_length", "choices", "missing" (message
+    for a missing or empty value) and "error" (message for any other failure).
+    validate() returns the normalized fields or raises ApiError on the first failure.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._checks = tuple(self._compile(name, spec) for name, spec in fields.items())
+
+    @staticmethod
+    def _compile(name, spec):
+        key = spec.get("key", name)
+        types = spec.get("type")
+        default = spec.get("default")
+        make_default = default if callable(default) else (lambda: default)
+        required = spec.get("required", False)
+        error = spec.get("error", f"Invalid {name}")
+        missing = spec.get("missing", error)
+        max_length = spec.get("max_length")
+        choices = spec.get("choices")
+
+        # Only the steps a field asks for end up in its check
+        steps = []
+        if types is not None:
+            def check_type(value):
+                if not isinstance(value, types):
+                    raise ApiError(error)
+                return value
+            steps.append(check_type)
+        if spec.get("strip"):
+            steps.append(str.strip)
+        if spec.get("nonempty"):
+            def check_nonempty(value):
+                if not value:
+                    raise ApiError(missing)
+                return value
+            steps.append(check_nonempty)
+        if max_length is not None:
+            def check_length(value):
+                if len(value) > max_length:
+                    raise ApiError(error)
+                return value
+            steps.append(check_length)
+        if choices is not None:
+            def check_choice(value):
+                if value not in choices:
+                    raise ApiError(error)
+                return value
+            steps.append(check_choice)
+
+        def check(data):
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise ApiError(missing)
+                return key, make_default()
+            for step in steps:
+                value = step(value)
+            return key, value
+        return check
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise ApiError("Request body must be a JSON object")
+        return dict(check(data) for check in self._checks)
+
+class ResponseCache:
+    """LRU cache of finished chat replies for deterministic requests.
+
+    Memory use is bounded by max_bytes and entries expire after ttl seconds. With a
+    Database for disk_path, entries are also written to SQLite so they survive
+    restarts; a disk hit is promoted back into memory.
+    """
+
+    def __init__(self, max_bytes, ttl, disk=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = disk
+        self._entries = OrderedDict()  # key -> (stored_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk is not None:
+            conn = disk.connection()
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+                conn.execute("DELETE FROM response_cache WHERE created_at < ?", (time.time() - ttl,))
+
+    def _remember(self, key, value, stored_at):
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old:
+            self._bytes -= old[1]
+        self._entries[key] = (stored_at, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                del self._entries[key]
+                self._bytes -= entry[1]
+
+        if self.disk is not None:
+            try:
+                row = self.disk.connection().execute(
+                    "SELECT value, created_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] < self.ttl:
+                    with self._lock:
+                        self._remember(key, row[0], row[1])
+                        self.hits += 1
+                    return row[0]
+            except Exception as e:
+                logger.error("Failed to read response cache: %s", e)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+        if self.disk is not None:
+            try:
+                conn = self.disk.connection()
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO response_cache (key, value, created_at) VALUES (?, ?, ?)",
+                                 (key, value, now))
+            except Exception as e:
+                logger.error("Failed to write response cache: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+response_cache = None
+
+def init_response_cache():
+    """Creates the response cache, or applies new limits to the running one on a config reload."""
+    global response_cache
+    enabled = RESPONSE_CACHE.get('enabled', True)
+    disk_path = RESPONSE_CACHE.get('disk_path')
+    if disk_path and not os.path.isabs(disk_path):
+        disk_path = os.path.join(script_dir, disk_path)
+    if response_cache is not None:
+        if not enabled or disk_path != (response_cache.disk.path if response_cache.disk else None):
+            logger.warning("Disabling the response cache or moving its disk tier takes effect after a restart")
+        with response_cache._lock:
+            response_cache.max_bytes = RESPONSE_CACHE.get('max_bytes', 16777216)
+            response_cache.ttl = RESPONSE_CACHE.get('ttl', 3600)
+            while response_cache._bytes > response_cache.max_bytes:
+                _, (_, evicted_size, _) = response_cache._entries.popitem(last=False)
+                response_cache._bytes -= evicted_size
+        return
+    if not enabled:
+        return
+    disk = None
+    if disk_path:
+        disk = Database(disk_path, busy_timeout=config.get('db_busy_timeout', 5))
+    response_cache = ResponseCache(RESPONSE_CACHE.get('max_bytes', 16777216), RESPONSE_CACHE.get('ttl', 3600), disk)
+    logger.info("Response cache enabled (disk tier: %s)", disk_path if disk else "none")
+
+# Sampling is reproducible only at temperature 0 or with a fixed seed
+def is_deterministic(options):
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+def response_cache_key(model, messages, options):
+    normalized = [{"role": m["role"].strip().lower(), "content": m["content"].strip()} for m in messages]
+    return hashlib.sha256(json_dumps([model, normalized, options], sort_keys=True)).hexdigest()
+
+class IdempotentRequest:
+    """A /chat request other requests with the same key can wait on.
+
+    reply stays None if the request ended without one (an error or a client that
+    went away); waiters then claim the key again and run the request themselves.
+    """
+
+    def __init__(self, store, key, fingerprint, keep):
+        self.store = store
+        self.key = key
+        self.fingerprint = fingerprint
+        self.keep = keep
+        self.plan = None
+        self.reply = None
+        self.cached = False
+        self.done = False
+        self.finished_at = None
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def wait(self):
+        """Blocks until the request finishes; returns whether it produced a reply."""
+        self._event.wait()
+        return self.reply is not None
+
+class IdempotencyStore:
+    """Requests by idempotency key: running ones, and finished ones kept for replay.
+
+    The first request to claim a key runs; later claims get its IdempotentRequest
+    to wait on. Replies of requests with keep set (an Idempotency-Key header) are
+    kept for ttl seconds, at most max_entries of them, and replayed to retries.
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._running = {}
+        self._finished = OrderedDict()  # key -> IdempotentRequest, oldest first
+        self._lock = threading.Lock()
+
+    def claim(self, key, fingerprint, keep):
+        """Returns (request, True) when the caller should run it, else (earlier request, False)."""
+        with self._lock:
+            now = time.time()
+            while self._finished:
+                oldest = next(iter(self._finished.values()))
+                if now - oldest.finished_at < self.ttl and len(self._finished) <= self.max_entries:
+                    break
+                self._finished.popitem(last=False)
+            entry = self._running.get(key) or self._finished.get(key)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    raise ApiError("Idempotency-Key was already used for a different request", 422)
+                return entry, False
+            entry = self._running[key] = IdempotentRequest(self, key, fingerprint, keep)
+            return entry, True
+
+    def finish(self, entry, plan=None, reply=None, cached=False):
+        """Records how a claimed request ended and wakes its waiters; later calls are ignored."""
+        with self._lock:
+            if entry.done:
+                return
+            entry.done = True
+            entry.finished_at = time.time()
+            if self._running.get(entry.key) is entry:
+                del self._running[entry.key]
+            if reply is not None:
+                # Only what chat_response_payload() needs, so kept entries stay small
+                entry.plan = {name: plan[name] for name in (
+                    "user_id", "user_input", "model", "use_context", "previous_messages", "trimmed_tokens")}
+                entry.reply = reply
+                entry.cached = cached
+                if entry.keep and self.ttl > 0:
+                    self._finished[entry.key] = entry
+            callbacks, entry._callbacks = entry._callbacks, []
+        entry._event.set()
+        for callback in callbacks:
+            callback()
+
+    def add_done_callback(self, entry, callback):
+        """Calls callback() (from whichever thread finishes entry) once entry is done."""
+        with self._lock:
+            if not entry.done:
+                entry._callbacks.append(callback)
+                return
+        callback()
+
+    def stats(self):
+        with self._lock:
+            return {"running": len(self._running), "kept": len(self._finished)}
+
+idempotency = None
+
+def init_idempotency():
+    """Creates the idempotency store, or applies new settings to it on a config reload."""
+    global idempotency
+    if not IDEMPOTENCY.get('enabled', True):
+        idempotency = None
+        return
+    if idempotency is None:
+        idempotency = IdempotencyStore()
+    idempotency.ttl = IDEMPOTENCY.get('ttl', 3600)
+    idempotency.max_entries = IDEMPOTENCY.get('max_entries', 1000)
+
+class RateLimiter:
+    """Token bucket per user_id.
+
+    Each request spends one token; tokens come back at rate per second up to burst.
+    Buckets are kept in memory (at most max_users, least recently used dropped
+    first), or with a Database for disk_path in SQLite, where every worker process
+    using the same file shares them.
+    """
+
+    def __init__(self, rate, burst, disk=None, max_users=100000):
+        self.rate = rate
+        self.burst = burst
+        self.disk = disk
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user_id -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self._takes = 0
+        self.limited = 0
+        if disk is not None:
+            conn = disk.connection()
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (user_id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def _spend(self, bucket, cost, now):
+        """Returns (tokens left, seconds to wait); the wait is 0 when the request may go ahead."""
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= cost:
+            return tokens - cost, 0.0
+        return tokens, (cost - tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def take(self, user_id, cost=1):
+        """Spends cost tokens from user_id's bucket; returns 0, or how many seconds to wait before retrying."""
+        now = time.time()
+        if self.disk is None:
+            with self._lock:
+                tokens, wait = self._spend(self._buckets.pop(user_id, None), cost, now)
+                self._buckets[user_id] = (tokens, now)
+                while len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+        else:
+            conn = self.disk.connection()
+            with timed_db('rate_limit'), conn:
+                conn.execute("BEGIN IMMEDIATE")
+                tokens, wait = self._spend(conn.execute(
+                    "SELECT tokens, updated_at FROM rate_limits WHERE user_id = ?", (user_id,)).fetchone(), cost, now)
+                conn.execute(
+                    "INSERT INTO rate_limits (user_id, tokens, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                    (user_id, tokens, now))
+                self._takes += 1
+                if self._takes % 1000 == 0 and self.rate > 0:
+                    # Buckets idle long enough to be full again are the same as no row
+                    conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (now - self.burst / self.rate,))
+        if wait:
+            self.limited += 1
+        return wait
+
+rate_limiter = None
+
+def init_rate_limiter():
+    """Creates the rate limiter, or applies new settings to it on a config reload."""
+    global rate_limiter
+    if not RATE_LIMIT.get('enabled', False):
+        rate_limiter = None
+        return
+    disk_path = RATE_LIMIT.get('disk_path')
+    if disk_path and not os.path.isabs(disk_path):
+        disk_path = os.path.join(script_dir, disk_path)
+    if rate_limiter is None or disk_path != (rate_limiter.disk.path if rate_limiter.disk else None):
+        disk = Database(disk_path, busy_timeout=config.get('db_busy_timeout', 5)) if disk_path else None
+        rate_limiter = RateLimiter(RATE_LIMIT.get('rate', 1.0), RATE_LIMIT.get('burst', 10), disk)
+        logger.info("Rate limit enabled: %s requests/s per user, bursts of %s (buckets in %s)",
+                    rate_limiter.rate, rate_limiter.burst, disk_path or "memory")
+    rate_limiter.rate = RATE_LIMIT.get('rate', 1.0)
+    rate_limiter.burst = RATE_LIMIT.get('burst', 10)
+
+CHAT_RATE_LIMITED = Counter('chat_rate_limited_total', 'Chat requests rejected by the per-user rate limit')
+CHAT_DEDUPLICATED = Counter('chat_deduplicated_total', 'Chat requests that matched a running or kept identical request',
+                            ('source',))
+
+def check_rate_limit(user_id, cost=1):
+    """Raises a 429 with Retry-After when user_id is over the rate limit."""
+    limiter = rate_limiter
+    if limiter is None:
+        return
+    wait = limiter.take(user_id, cost)
+    if wait:
+        CHAT_RATE_LIMITED.inc()
+        logger.info("Rate limited user %s for %.1fs", user_id, wait)
+        # With a rate of 0 spent tokens never come back, so there is no time to give
+        headers = {"Retry-After": str(max(1, round(wait)))} if wait != float('inf') else None
+        raise ApiError("Rate limit exceeded; slow down", 429, headers=headers)
+
+class SchedulerTicket:
+    def __init__(self, model, user_id, notify):
+        self.model = model
+        self.user_id = user_id
+        self.notify = notify
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.granted = False
+        self.released = False
+
+class ModelScheduler:
+    """Per-model admission control in front of /api/chat.
+
+    At most max_in_flight generations run per model. The rest wait in a bounded
+    queue that is served round-robin across user_ids, so one busy client cannot
+    starve the others. A request that would overflow the queue (429) or whose
+    estimated wait exceeds max_wait (503) is rejected at once with Retry-After.
+    """
+
+    def __init__(self, limits_for):
+        self.limits_for = limits_for
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def _queue(self, model):
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = {
+                "limits": self.limits_for(model),
+                "in_flight": 0,
+                "waiting": OrderedDict(),  # user_id -> deque of tickets, in round-robin order
+                "depth": 0,
+                "avg_service": 0.0,
+                "avg_wait": 0.0,
+                "max_wait_seen": 0.0,
+                "admitted": 0,
+                "rejected": 0
+            }
+        return queue
+
+    @staticmethod
+    def _estimate_wait(queue, position):
+        # Waves of max_in_flight requests, each taking about the average service time
+        waves = -(-position // queue["limits"]["max_in_flight"])
+        return waves * queue["avg_service"]
+
+    def _grant(self, queue, ticket):
+        ticket.granted = True
+        ticket.granted_at = time.monotonic()
+        waited = ticket.granted_at - ticket.enqueued_at
+        queue["in_flight"] += 1
+        queue["admitted"] += 1
+        queue["avg_wait"] = waited if queue["admitted"] == 1 else 0.8 * queue["avg_wait"] + 0.2 * waited
+        queue["max_wait_seen"] = max(queue["max_wait_seen"], waited)
+        QUEUE_WAIT_SECONDS.observe(waited, model=ticket.model)
+
+    def _dispatch(self, queue):
+        waiting = queue["waiting"]
+        while waiting and queue["in_flight"] < queue["limits"]["max_in_flight"]:
+            user_id, tickets = next(iter(waiting.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                waiting.move_to_end(user_id)
+            else:
+                del waiting[user_id]
+            queue["depth"] -= 1
+            self._grant(queue, ticket)
+            ticket.notify()
+
+    def refresh_limits(self):
+        """Re-reads every model's limits (after a config reload) and admits waiters a raised limit allows."""
+        with self._lock:
+            for model, queue in self._queues.items():
+                queue["limits"] = self.limits_for(model)
+                self._dispatch(queue)
+
+    def enqueue(self, model, user_id, notify):
+        """Admits or queues a request; notify() is called (under the lock) once a queued ticket is granted."""
+        with self._lock:
+            queue = self._queue(model)
+            limits = queue["limits"]
+            ticket = SchedulerTicket(model, user_id, notify)
+            if queue["in_flight"] < limits["max_in_flight"] and not queue["depth"]:
+                self._grant(queue, ticket)
+                return ticket
+
+            if queue["depth"] >= limits["max_queue"]:
+                queue["rejected"] += 1
+                retry_after = max(1, round(self._estimate_wait(queue, queue["depth"])))
+                logger.warning("Queue for model %s is full (%s waiting)", model, queue['depth'])
+                raise ApiError(f"Too many requests queued for model {model}", 429,
+                               headers={"Retry-After": str(retry_after)})
+
+            estimate = self._estimate_wait(queue, queue["depth"] + 1)
+            if estimate > limits["max_wait"]:
+                queue["rejected"] += 1
+                logger.warning("Estimated wait for model %s is %.1fs; rejecting", model, estimate)
+                raise ApiError(f"Model {model} is busy; estimated wait {round(estimate)}s", 503,
+                               headers={"Retry-After": str(max(1, round(estimate - limits["max_wait"])))})
+
+            queue["waiting"].setdefault(user_id, deque()).append(ticket)
+            queue["depth"] += 1
+            return ticket
 
-# Default config
-default_config = {
-    "log_path": "flask.log",
-    "ollama_server": "http://localhost:11434",
-    "use_context": True,
-    "flask_host": "0.0.0.0",
-    "flask_port": 6000,
-    "flask_debug": False,
-    "db_path": "user_contexts.db"
-}
+    def acquire(self, model, user_id):
+        """Blocks until a slot for model is free; the caller must release() the ticket."""
+        granted = threading.Event()
+        ticket = self.enqueue(model, user_id, granted.set)
+        if not ticket.granted:
+            max_wait = self._queues[model]["limits"]["max_wait"]
+            if not granted.wait(max_wait):
+                self.release(ticket)
+                logger.warning("Request for model %s waited %ss in queue; giving up", model, max_wait)
+                raise ApiError(f"Timed out waiting for model {model}", 503, headers={"Retry-After": "1"})
+        return ticket
 
-# Load config
-config_path = os.path.join(script_dir, 'config.json')
-config = {}
-try:
-    with open(config_path, 'r') as f:
-        config = json.load(f)
-    logger.info('Config loaded successfully')
-except FileNotFoundError:
-    logger.info(f'Config file not found at {config_path}; creating with defaults')
-    with open(config_path, 'w') as f:
-        json.dump(default_config, f, indent=4)
-    config = default_config
-except json.JSONDecodeError as e:
-    logger.warning(f'Invalid JSON in config file: {e}, using defaults')
-    config = default_config
-except Exception as e:
-    logger.warning(f'Failed to load config: {e}, using defaults')
-    config = default_config
-
-# Set log path and add file handler
-log_path = config.get('log_path', 'flask.log')
-if not os.path.isabs(log_path):
-    log_path = os.path.join(script_dir, log_path)
-try:
-    fh = logging.FileHandler(log_path)
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-    logger.addHandler(fh)
-    logger.info(f'File logging enabled at {log_path}')
-except Exception as e:
-    logger.warning(f'Failed to add file handler: {e}')
-
-# Other configs
-OLLAMA_SERVER = config.get('ollama_server', os.getenv("OLLAMA_SERVER", "http://localhost:11434"))
-USE_CONTEXT = config.get('use_context', True)
-flask_host = config.get('flask_host', "0.0.0.0")
-flask_port = config.get('flask_port', 6000)
-flask_debug = config.get('flask_debug', False)
-
-# Database path
-db_default = 'user_contexts.db'
-db_config_path = config.get('db_path', db_default)
-if os.path.isabs(db_config_path):
-    db_path = db_config_path
-else:
-    db_path = os.path.join(script_dir, db_config_path)
+    def release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            queue = self._queues[ticket.model]
+            if ticket.granted:
+                queue["in_flight"] -= 1
+                service = time.monotonic() - ticket.granted_at
+                queue["avg_service"] = service if not queue["avg_service"] else 0.8 * queue["avg_service"] + 0.2 * service
+                self._dispatch(queue)
+                return
+            # Gave up while still queued
+            tickets = queue["waiting"].get(ticket.user_id)
+            if tickets and ticket in tickets:
+                tickets.remove(ticket)
+                queue["depth"] -= 1
+                if not tickets:
+                    del queue["waiting"][ticket.user_id]
 
-app = Flask(__name__)
-CORS(app)
+    def stats(self):
+        with self._lock:
+            return {
+                model: {
+                    "in_flight": queue["in_flight"],
+                    "queued": queue["depth"],
+                    "queued_users": len(queue["waiting"]),
+                    "max_in_flight": queue["limits"]["max_in_flight"],
+                    "max_queue": queue["limits"]["max_queue"],
+                    "avg_service_seconds": round(queue["avg_service"], 3),
+                    "avg_wait_seconds": round(queue["avg_wait"], 3),
+                    "max_wait_seconds": round(queue["max_wait_seen"], 3),
+                    "estimated_wait_seconds": round(self._estimate_wait(queue, queue["depth"] + 1), 3),
+                    "admitted": queue["admitted"],
+                    "rejected": queue["rejected"]
+                }
+                for model, queue in self._queues.items()
+            }
 
-# Initialize SQLite database for contexts and loaded model
-def init_db():
-    try:
-        # Check if database file is accessible
-        if not os.path.exists(db_path):
-            logger.info(f"Database file {db_path} does not exist; creating...")
-        elif not os.access(db_path, os.R_OK | os.W_OK):
-            logger.error(f"Database file {db_path} exists but is not readable/writable")
-            raise PermissionError(f"Database file {db_path} is not accessible")
+def backend_slots(model):
+    """Generations of model one backend runs at once (the scheduler's max_in_flight)."""
+    return per_model_config(SCHEDULER, model, {"max_in_flight": 4})["max_in_flight"]
 
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS contexts (user_id TEXT PRIMARY KEY, context TEXT)")
-        c.execute("CREATE TABLE IF NOT EXISTS loaded_model (id INTEGER PRIMARY KEY CHECK (id = 1), name TEXT)")
-        conn.commit()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize database: {e}")
-        raise
-    finally:
-        conn.close()
+def scheduler_limits_for(model):
+    limits = per_model_config(SCHEDULER, model, {"max_in_flight": 4, "max_queue": 32, "max_wait": 120})
+    # max_in_flight is per backend; the router spreads the slots over them
+    limits["max_in_flight"] *= len(router.backends)
+    return limits
+
+scheduler = ModelScheduler(scheduler_limits_for)
+
+QUEUE_WAIT_SECONDS = Histogram('chat_queue_wait_seconds', 'Time /chat requests waited for a scheduler slot', ('model',))
+QUEUE_DEPTH = Gauge('chat_queue_depth', 'Requests waiting for a scheduler slot', ('model',))
+QUEUE_IN_FLIGHT = Gauge('chat_in_flight', 'Generations running per model', ('model',))
+QUEUE_REJECTED = Gauge('chat_rejected', 'Requests rejected by the scheduler since startup', ('model',))
+RESPONSE_CACHE_STATS = Gauge('response_cache', 'Response cache entries, bytes, hits and misses', ('stat',))
+CONTEXT_CACHE_STATS = Gauge('context_cache', 'Context cache entries, bytes, hit rate and write-behind lag', ('stat',))
+BACKEND_IN_FLIGHT = Gauge('ollama_backend_in_flight', 'Requests in flight per Ollama backend', ('backend',))
+BACKEND_HEALTHY = Gauge('ollama_backend_healthy', 'Whether an Ollama backend is taking traffic (1) or ejected (0)', ('backend',))
+
+def collect_runtime_metrics():
+    for model, stats in scheduler.stats().items():
+        QUEUE_DEPTH.set(stats["queued"], model=model)
+        QUEUE_IN_FLIGHT.set(stats["in_flight"], model=model)
+        QUEUE_REJECTED.set(stats["rejected"], model=model)
+    if response_cache is not None:
+        for stat, value in response_cache.stats().items():
+            RESPONSE_CACHE_STATS.set(value, stat=stat)
+    if context_cache is not None:
+        for stat, value in context_cache.stats().items():
+            CONTEXT_CACHE_STATS.set(value, stat=stat)
+    for backend in router.backends:
+        BACKEND_IN_FLIGHT.set(backend.in_flight, backend=backend.name)
+        BACKEND_HEALTHY.set(1 if backend.healthy else 0, backend=backend.name)
+
+metrics_collectors.append(collect_runtime_metrics)
 
-def save_context(user_id, context):
+def sse_event(payload):
+    """Formats a payload as a Server-Sent Events data frame."""
+    data = payload if isinstance(payload, str) else json_dumps(payload).decode()
+    return f"data: {data}\n\n"
+
+def wants_stream(data, accept=""):
+    """A chat request streams when it sets "stream": true or accepts text/event-stream."""
+    if "stream" in data:
+        return bool(data.get("stream"))
+    return "text/event-stream" in accept
+
+# The steps below are shared by the Flask routes and the asyncio entry point (llmapi_asgi.py);
+# only the upstream /api/chat call differs between the two.
+
+CHAT_REQUEST_SCHEMA = Schema({
+    "user_id": {"type": str, "default": "default", "nonempty": True, "max_length": 100,
+                "error": "Invalid or missing user_id"},
+    "message": {"type": str, "key": "user_input", "required": True, "strip": True, "nonempty": True,
+                "missing": "Message is required", "error": "message must be a string"},
+    "use_context": {"default": lambda: USE_CONTEXT},
+    "model": {"type": str, "error": "model must be a string"},
+    "options": {"type": dict, "default": dict, "error": "options must be an object"},
+    "context_echo": {"type": str, "default": lambda: CONTEXT_ECHO, "choices": ("full", "delta", "none"),
+                     "error": "context_echo must be one of full, delta, none"}
+})
+
+def parse_chat_request(data):
+    """Validates a /chat body and returns its fields; the model may still be None."""
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO contexts (user_id, context) VALUES (?, ?)",
-                  (user_id, json.dumps(context)))
-        conn.commit()
-        logger.debug(f"Saved context for user {user_id}")
-    except Exception as e:
-        logger.error(f"Failed to save context for user {user_id}: {e}")
-    finally:
-        conn.close()
+        return CHAT_REQUEST_SCHEMA.validate(data)
+    except ApiError as e:
+        logger.warning("Rejected chat request: %s", e)
+        raise
+
+def resolve_default_model():
+    """The model used when a request names none: the loaded one, else the first available."""
+    with timed_stage("resolve_model"):
+        model = get_loaded_model()
+        if model:
+            logger.info("No model specified; using loaded model: %s", model)
+            return model
+        # Fallback to first available model from /api/tags
+        available_models = poll_ollama_models()
+        if not available_models:
+            logger.warning("No model specified and no models available")
+            raise ApiError("Model is required and no models are available")
+        logger.info("No model loaded; using first available model: %s", available_models[0])
+        return available_models[0]
+
+def check_model_available(model, models):
+    if model not in models:
+        logger.warning("Model %s not found in available models", model)
+        raise ApiError(f"Model {model} not found")
+
+def build_plan(fields, previous_messages, trimmed_tokens):
+    plan = dict(fields, previous_messages=previous_messages, trimmed_tokens=trimmed_tokens, cache_key=None)
+    if response_cache is not None and is_deterministic(plan["options"]):
+        plan["cache_key"] = response_cache_key(
+            plan["model"], ollama_chat_payload(plan, False)["messages"], plan["options"])
+    return plan
+
+def prepare_chat(data):
+    """Validates a /chat body and resolves the model and context ahead of the Ollama call."""
+    fields = parse_chat_request(data)
+    # Charged before any lookups, so a throttled client costs no Ollama calls or context reads
+    check_rate_limit(fields["user_id"])
+    if not fields["model"]:
+        fields["model"] = resolve_default_model()
+
+    # Verify model exists via /api/tags
+    with timed_stage("verify_model"):
+        models = poll_ollama_models()
+    check_model_available(fields["model"], models)
+
+    user_id = fields["user_id"]
+    history = None
+    with timed_stage("load_context"):
+        if fields["use_context"]:
+            history = load_history(user_id)
+            previous_messages, trimmed_tokens = assemble_context(user_id, fields["model"], fields["user_input"], history)
+        else:
+            previous_messages, trimmed_tokens = [], 0
+    logger.debug("Context for user %s: %s", user_id, Truncated(previous_messages))
+    plan = build_plan(fields, previous_messages, trimmed_tokens)
+    plan["context_version"] = context_version(history)
+    return plan
+
+def context_version(history):
+    """The seq of the newest message (or summary) in a (summary, rows) history, 0 if there is none."""
+    if not history:
+        return 0
+    summary, rows = history
+    return rows[-1][0] if rows else (summary[0] if summary else 0)
+
+def ollama_chat_payload(plan, stream):
+    payload = {
+        "model": plan["model"],
+        "messages": plan["previous_messages"] + [{"role": "user", "content": plan["user_input"]}],
+        "stream": stream,
+        "keep_alive": -1
+    }
+    if plan["options"]:
+        payload["options"] = plan["options"]
+    return payload
+
+def cached_reply(plan):
+    """Returns a cached reply for a deterministic request, or None."""
+    if not plan["cache_key"]:
+        return None
+    with timed_stage("cache_lookup"):
+        ai_response = response_cache.get(plan["cache_key"])
+    if ai_response is not None:
+        logger.info("Response cache hit for model %s", plan['model'])
+    return ai_response
+
+def parse_chat_result(status_code, body):
+    """Checks a non-streamed /api/chat reply (raw bytes or text) and returns the decoded result."""
+    logger.debug("Ollama /api/chat response: %s - %s", status_code, Truncated(body))
+    if status_code != 200:
+        text = body.decode(errors="replace") if isinstance(body, bytes) else body
+        logger.error("Ollama chat request failed: %s - %s", status_code, Truncated(text))
+        raise ApiError("Failed to get response from Ollama", 500, status=status_code, response=text)
 
-def load_context(user_id):
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("SELECT context FROM contexts WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        return json.loads(result[0]) if result else []
-    except Exception as e:
-        logger.error(f"Failed to load context for user {user_id}: {e}")
-        return []
-    finally:
-        conn.close()
+        result = json_loads(body)
+    except ValueError as e:
+        logger.error("Failed to parse Ollama response as JSON: %s", e)
+        raise ApiError("Invalid response from Ollama server", 500)
+    if result.get("model"):
+        record_generation_stats(result["model"], result)
 
-def save_loaded_model(model):
+    if not result.get("message", {}).get("content", ""):
+        logger.warning("No content in Ollama response")
+        raise ApiError("No response content from AI", 500)
+    return result
+
+def complete_chat(plan, ai_response, cached=False, pending=None):
+    """Persists a finished turn; fresh replies are also cached and mark the model as loaded.
+
+    With a pending list the turn is appended to it, for a later save_contexts(), instead
+    of being written straight away.
+    """
+    if plan["use_context"]:
+        turn = [
+            {"role": "user", "content": plan["user_input"]},
+            {"role": "assistant", "content": ai_response}
+        ]
+        if pending is not None:
+            pending.append((plan["user_id"], turn))
+        else:
+            with timed_stage("save_context"):
+                save_context(plan["user_id"], turn)
+    claim = plan.get("claim")
+    if claim is not None:
+        claim.store.finish(claim, plan, ai_response, cached)
+    if cached:
+        return
+    if plan["cache_key"]:
+        response_cache.put(plan["cache_key"], ai_response)
+    note_model_running(plan["model"], plan.get("backend"))
+    save_loaded_model(plan["model"])
+
+def chat_response_payload(plan, ai_response, cached=False):
+    with timed_stage("clean_response"):
+        cleaned_response = clean_response(ai_response)
+    logger.debug("Cleaned response: %s", Truncated(cleaned_response))
+
+    payload = {
+        "choices": [{"message": {"content": cleaned_response}}],
+        "trimmed_tokens": plan["trimmed_tokens"],
+        "cached": cached
+    }
+    new_turn = [{"role": "user", "content": plan["user_input"]}, {"role": "assistant", "content": ai_response}]
+    if plan["context_echo"] == "full":
+        payload["context"] = plan["previous_messages"] + new_turn if plan["use_context"] else []
+    elif plan["context_echo"] == "delta":
+        payload["context"] = new_turn if plan["use_context"] else []
+    return payload
+
+# Sent with a reply that was produced for an earlier request with the same idempotency key
+REPLAYED_HEADERS = {"Idempotent-Replayed": "true"}
+
+def chat_request_key(plan, idempotency_key=None):
+    """(key, fingerprint, keep) identifying a /chat request for deduplication.
+
+    With an Idempotency-Key header the key is that header, per user, and the reply
+    is kept for replay. Otherwise it is the request itself at the user's current
+    context version, which stops matching once the request's turn has been saved.
+    """
+    fingerprint = hashlib.sha256(json_dumps(
+        [plan["user_id"], plan["user_input"], plan["model"], plan["options"], plan["use_context"]],
+        sort_keys=True)).hexdigest()
+    if idempotency_key:
+        if len(idempotency_key) > 255:
+            raise ApiError("Idempotency-Key must be at most 255 characters")
+        key = hashlib.sha256(json_dumps([plan["user_id"], idempotency_key])).hexdigest()
+        return "key:" + key, fingerprint, True
+    return f"request:{fingerprint}:{plan['context_version']}", fingerprint, False
+
+def claim_chat(plan, idempotency_key=None, wait=True):
+    """Deduplicates a prepared /chat request.
+
+    Returns None when this request should run; it then holds the claim until
+    complete_chat() or release_claim(). Otherwise returns the IdempotentRequest of
+    an identical earlier request. With wait, that request has finished with a reply
+    (if it failed, this one claims the key again); without, it may still be running.
+    """
+    while True:
+        store = idempotency
+        if store is None:
+            return None
+        entry, owner = store.claim(*chat_request_key(plan, idempotency_key))
+        if owner:
+            plan["claim"] = entry
+            return None
+        CHAT_DEDUPLICATED.inc(source="kept" if entry.done else "running")
+        if not wait or entry.wait():
+            return entry
+        logger.info("Earlier identical request for user %s failed; running this one", plan["user_id"])
+
+def release_claim(plan):
+    """Gives up plan's claim without a reply, so requests waiting on it run themselves."""
+    claim = plan.get("claim")
+    if claim is not None:
+        claim.store.finish(claim)
+
+def replay_plan(original, plan):
+    """The plan to build a duplicate's response from: the original's, echoed as the duplicate asked."""
+    return dict(original.plan, context_echo=plan["context_echo"])
+
+class ChatStreamRelay:
+    """Turns Ollama's streamed /api/chat NDJSON lines into SSE frames.
+
+    feed_line() returns the frames for one upstream line and sets done once the
+    stream has finished or failed. finish() persists the transcript, which only
+    happens after the whole completion has arrived, and returns the closing frames.
+    With save off (replaying another request's reply) nothing is persisted.
+    """
+
+    def __init__(self, plan, cached=False, save=True):
+        self.plan = plan
+        self.cached = cached
+        self.save = save
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.stripper = ThinkStripper()
+        self.parts = []
+        self.done = False
+        self.completed = False
+        self.failed = False
+
+    def _fail(self, message):
+        self.done = True
+        self.failed = True
+        return [sse_event({"error": message})]
+
+    def feed_line(self, line):
+        if not line:
+            return []
+        try:
+            chunk = json_loads(line)
+        except ValueError as e:
+            logger.error("Failed to parse Ollama stream chunk as JSON: %s", e)
+            return self._fail("Invalid response from Ollama server")
+        if chunk.get("error"):
+            logger.error("Ollama stream error: %s", chunk['error'])
+            return self._fail(chunk["error"])
+
+        frames = []
+        content = chunk.get("message", {}).get("content", "")
+        if content:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+                CHAT_FIRST_TOKEN_SECONDS.observe(self.first_token - self.started, model=self.plan["model"])
+            self.parts.append(content)
+            visible = self.stripper.feed(content)
+            if visible:
+                frames.append(sse_event({"choices": [{"delta": {"content": visible}}]}))
+        if chunk.get("done"):
+            self.done = True
+            self.completed = True
+            CHAT_STAGE_SECONDS.observe(time.perf_counter() - self.started, stage="upstream")
+            record_generation_stats(self.plan["model"], chunk)
+        return frames
+
+    def error(self, message):
+        return self._fail(message)
+
+    def replay(self, ai_response):
+        """Streams a complete (cached) reply as if it had just arrived."""
+        self.parts = [ai_response]
+        self.done = True
+        self.completed = True
+        visible = self.stripper.feed(ai_response)
+        frames = [sse_event({"choices": [{"delta": {"content": visible}}]})] if visible else []
+        return frames + self.finish()
+
+    def finish(self):
+        if self.failed:
+            return []
+        if not self.completed:
+            logger.warning("Ollama stream ended before completion")
+            return self._fail("Incomplete response from Ollama")
+
+        frames = []
+        tail = self.stripper.flush()
+        if tail:
+            frames.append(sse_event({"choices": [{"delta": {"content": tail}}]}))
+
+        ai_response = "".join(self.parts)
+        if not ai_response:
+            logger.warning("No content in Ollama stream")
+            return frames + self._fail("No response content from AI")
+
+        if self.save:
+            complete_chat(self.plan, ai_response, cached=self.cached)
+        frames.append(sse_event({
+            "choices": [{"delta": {}, "finish_reason": "stop"}],
+            "trimmed_tokens": self.plan["trimmed_tokens"],
+            "cached": self.cached
+        }))
+        frames.append(sse_event("[DONE]"))
+        return frames
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def stream_chat(plan, ticket):
+    """Relays Ollama's NDJSON chunks to the client as SSE and saves the transcript at the end.
+
+    The scheduler ticket and the backend lease are held until the stream finishes or
+    the client goes away.
+    """
+    relay = ChatStreamRelay(plan)
+    lease = router.acquire(plan["model"], plan["user_id"])
+    plan["backend"] = lease.backend
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO loaded_model (id, name) VALUES (1, ?)", (model,))
-        conn.commit()
-        logger.debug(f"Saved loaded model: {model}")
-    except Exception as e:
-        logger.error(f"Failed to save loaded model: {e}")
-    finally:
-        conn.close()
+        response = lease.backend.post("/api/chat", ollama_chat_payload(plan, stream=True), stream=True)
+    except Exception:
+        lease.release()
+        raise
+    if response.status_code != 200:
+        logger.error("Ollama chat stream request failed: %s - %s", response.status_code, Truncated(response.text))
+        body = response.text
+        response.close()
+        lease.release()
+        raise ApiError("Failed to get response from Ollama", 500, status=response.status_code, response=body)
 
-def get_loaded_model():
+    def generate():
+        try:
+            for line in response.iter_lines():
+                if not relay.done:
+                    yield from relay.feed_line(line)
+                elif relay.failed:
+                    break
+                # Past the final chunk, read on to the end of the body so the
+                # connection goes back to the pool instead of being dropped
+            yield from relay.finish()
+        except requests.RequestException as e:
+            logger.error("Network error while streaming: %s", e)
+            yield from relay.error(f"Network error: {str(e)}")
+        finally:
+            response.close()
+            lease.release()
+            scheduler.release(ticket)
+            release_claim(plan)
+
+    def release():
+        lease.release()
+        scheduler.release(ticket)
+        release_claim(plan)
+
+    streamed = Response(stream_with_context(generate()), mimetype="text/event-stream", headers=SSE_HEADERS)
+    # Covers clients that disconnect before the first chunk is produced
+    streamed.call_on_close(release)
+    return streamed
+
+class ChatBatch:
+    """Runs the items of a /chat/batch request and yields NDJSON result lines.
+
+    Models are resolved and contexts read once for the whole batch. Items run on the
+    thread pool shared by all batches (batch_executor()). A batch only hands the
+    pool as many items per model as max_in_flight allows, and submits the next as
+    one finishes, so a large batch never parks pool threads that other batches
+    need. Results are yielded in completion order. Items that share a user_id and
+    use context run one after another, each seeing the turns before it. Finished
+    turns are written in one transaction whenever the batch is waiting on Ollama,
+    and at the end.
+    """
+
+    def __init__(self, items):
+        self.results = SimpleQueue()
+        self.pending = deque()
+        self.cancelled = False
+        self.ready = []
+        self.chains = []
+        self._limits = {}  # model -> items of this batch that may run at once
+        self._running = {}  # model -> items of this batch submitted and not finished
+        self._waiting = {}  # model -> deque of chains whose next item waits for a slot
+        self._futures = []
+        self._lock = threading.Lock()
+
+        parsed = []
+        for index, item in enumerate(items):
+            try:
+                fields = parse_chat_request(item)
+                check_rate_limit(fields["user_id"])
+                parsed.append((index, fields))
+            except ApiError as e:
+                self.ready.append(self.error_line(index, e))
+
+        default_model = None
+        if any(not fields["model"] for _, fields in parsed):
+            try:
+                default_model = resolve_default_model()
+            except ApiError as e:
+                default_model = e
+        with timed_stage("verify_model"):
+            models = poll_ollama_models()
+
+        contexts = load_contexts({fields["user_id"] for _, fields in parsed if fields["use_context"]})
+        user_chains = {}
+        for index, fields in parsed:
+            try:
+                if not fields["model"]:
+                    if isinstance(default_model, ApiError):
+                        raise default_model
+                    fields["model"] = default_model
+                check_model_available(fields["model"], models)
+            except ApiError as e:
+                self.ready.append(self.error_line(index, e))
+                continue
+            if fields["use_context"]:
+                user_id = fields["user_id"]
+                if user_id not in user_chains:
+                    summary, rows = contexts[user_id]
+                    user_chains[user_id] = {"history": (summary, rows), "items": deque()}
+                    self.chains.append(user_chains[user_id])
+                user_chains[user_id]["items"].append((index, fields))
+            else:
+                self.chains.append({"history": None, "items": deque([(index, fields)])})
+
+    @staticmethod
+    def error_line(index, error):
+        if isinstance(error, ApiError):
+            return {"index": index, "status": error.status, **error.payload}
+        if isinstance(error, requests.Timeout):
+            return {"index": index, "status": 500, "error": "Request timed out. Please try again later."}
+        if isinstance(error, requests.RequestException):
+            return {"index": index, "status": 500, "error": f"Network error: {str(error)}"}
+        return {"index": index, "status": 500, "error": f"Unexpected error: {str(error)}"}
+
+    def _start(self, chain):
+        """Submits the chain's next item, or parks the chain until its model has a free slot.
+
+        Called with self._lock held.
+        """
+        model = chain["items"][0][1]["model"]
+        if model not in self._limits:
+            self._limits[model] = scheduler_limits_for(model)["max_in_flight"]
+        if self._running.get(model, 0) >= self._limits[model]:
+            self._waiting.setdefault(model, deque()).append(chain)
+            return
+        self._running[model] = self._running.get(model, 0) + 1
+        self._futures.append(batch_executor().submit(self._run_next, chain, model))
+
+    def _run_item(self, index, fields, history):
+        with timed_stage("load_context"):
+            previous_messages, trimmed_tokens = (
+                assemble_context(fields["user_id"], fields["model"], fields["user_input"], history)
+                if fields["use_context"] else ([], 0))
+        plan = build_plan(fields, previous_messages, trimmed_tokens)
+
+        ai_response = cached_reply(plan)
+        cached = ai_response is not None
+        if not cached:
+            with timed_stage("queue_wait"):
+                ticket = scheduler.acquire(plan["model"], plan["user_id"])
+            try:
+                with router.acquire(plan["model"], plan["user_id"]) as backend, timed_stage("upstream"):
+                    plan["backend"] = backend
+                    response = backend.post("/api/chat", ollama_chat_payload(plan, stream=False))
+            finally:
+                scheduler.release(ticket)
+            ai_response = parse_chat_result(response.status_code, response.content)["message"]["content"]
+
+        complete_chat(plan, ai_response, cached=cached, pending=self.pending)
+        if history is not None:
+            rows = history[1]
+            seq = context_version(history)
+            rows.append((seq + 1, "user", plan["user_input"], estimate_tokens(plan["user_input"])))
+            rows.append((seq + 2, "assistant", ai_response, estimate_tokens(ai_response)))
+        return {"index": index, **chat_response_payload(plan, ai_response, cached=cached)}
+
+    def _run_next(self, chain, model):
+        index, fields = chain["items"].popleft()
+        try:
+            line = self._run_item(index, fields, chain["history"])
+        except Exception as e:
+            if not isinstance(e, (ApiError, requests.RequestException)):
+                logger.error("Unexpected error in batch item %s: %s", index, e)
+            line = self.error_line(index, e)
+        self.results.put(line)
+        with self._lock:
+            self._running[model] -= 1
+            if self.cancelled:
+                return
+            # Chains already waiting for this model go before this chain's next item
+            waiting = self._waiting.get(model)
+            if waiting:
+                self._start(waiting.popleft())
+            if chain["items"]:
+                self._start(chain)
+
+    def flush(self):
+        turns = []
+        while self.pending:
+            turns.append(self.pending.popleft())
+        if turns:
+            with timed_stage("save_context"):
+                save_contexts(turns)
+
+    def __iter__(self):
+        for line in self.ready:
+            yield json_dumps(line) + b"\n"
+        remaining = sum(len(chain["items"]) for chain in self.chains)
+        if not remaining:
+            return
+        try:
+            with self._lock:
+                for chain in self.chains:
+                    self._start(chain)
+            while remaining:
+                try:
+                    line = self.results.get_nowait()
+                except Empty:
+                    # Nothing finished yet: a good moment to write what has
+                    self.flush()
+                    line = self.results.get()
+                remaining -= 1
+                yield json_dumps(line) + b"\n"
+        finally:
+            # Also reached when the client disconnects: start no new items, finish and save the rest
+            with self._lock:
+                self.cancelled = True
+                futures = list(self._futures)
+            for future in futures:
+                future.cancel()
+            wait_for_futures(futures)
+            self.flush()
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def batch_executor():
+    """The pool that runs batch items, batch_workers threads shared by every batch.
+
+    Its threads live as long as the pool, so each opens its database connection once.
+    A reload that changes batch_workers gets a new pool; the old one finishes its items.
+    """
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None or _batch_executor._max_workers != BATCH_WORKERS:
+            if _batch_executor is not None:
+                _batch_executor.shutdown(wait=False)
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="chat-batch")
+        return _batch_executor
+
+def parse_batch(data):
+    """Returns the item list of a /chat/batch body, either {"items": [...]} or a bare list."""
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise ApiError("items must be a non-empty list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ApiError(f"A batch can hold at most {BATCH_MAX_ITEMS} items", 413)
+    return items
+
+load_jobs = {}
+_load_jobs_lock = threading.Lock()
+LOAD_JOB_RETENTION = 3600
+
+def update_load_job(job, **fields):
+    if job is None:
+        return
+    with _load_jobs_lock:
+        job.update(fields, updated_at=time.time())
+
+def pull_model(model, backend, job=None):
+    """Pulls a model onto backend, streaming /api/pull so progress can be reported on the job."""
+    response = backend.post("/api/pull", {"name": model, "stream": True}, timeout=backend.pull_timeout, stream=True)
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("SELECT name FROM loaded_model WHERE id = 1")
-        result = c.fetchone()
-        model = result[0] if result else None
-        if model and not is_model_loaded(model):
-            save_loaded_model(None)
-            model = None
-        logger.debug(f"Retrieved loaded model: {model}")
-        return model
-    except Exception as e:
-        logger.error(f"Failed to get loaded model: {e}")
-        return None
+        if response.status_code != 200:
+            logger.error("Failed to pull model %s: %s - %s", model, response.status_code, Truncated(response.text))
+            raise ApiError(f"Failed to pull model: {response.text}", 500)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json_loads(line)
+            if chunk.get("error"):
+                logger.error("Failed to pull model %s: %s", model, chunk['error'])
+                raise ApiError(f"Failed to pull model: {chunk['error']}", 500)
+            fields = {"detail": chunk.get("status")}
+            if chunk.get("total") and chunk.get("completed") is not None:
+                fields["progress"] = round(chunk["completed"] / chunk["total"] * 100, 1)
+            update_load_job(job, **fields)
     finally:
-        conn.close()
+        response.close()
+
+def run_load_pipeline(model, job=None, backend=None):
+    """Pulls the model if needed, loads it and waits until /api/ps lists it.
+
+    Without a backend the router picks one, preferring backends that already have
+    the model. Returns the backend; raises ApiError on failure. With a job, each
+    stage is recorded on it.
+    """
+    backend = backend or router.choose(model)
+    update_load_job(job, backend=backend.name)
+
+    # Verify model exists via /api/tags; pull if not
+    models = backend.available_models()
+    if model not in models:
+        logger.info("Model %s not found on %s; pulling...", model, backend.name)
+        update_load_job(job, state="pulling")
+        pull_model(model, backend, job)
+        # Repoll after pull
+        models = backend.available_models(refresh=True)
+        if model not in models:
+            raise ApiError(f"Model {model} not available after pull", 500)
+
+    # Load model into memory with a dummy generate call
+    logger.info("Loading model %s into memory on %s", model, backend.name)
+    update_load_job(job, state="loading", detail=None)
+    load_response = backend.post(
+        "/api/generate",
+        {
+            "model": model,
+            "prompt": "",
+            "stream": False,
+            "keep_alive": -1
+        },
+        timeout=max(backend.read_timeout, MODEL_READY_TIMEOUT)
+    )
+    if load_response.status_code != 200:
+        logger.error("Failed to load model %s: %s - %s", model, load_response.status_code, Truncated(load_response.text))
+        raise ApiError(f"Failed to load model: {load_response.text}", 500)
+
+    # Verify model is loaded
+    backend.invalidate()
+    if not wait_for_model_state(model, loaded=True, backend=backend):
+        logger.error("Model %s not listed in /api/ps after loading", model)
+        raise ApiError(f"Model {model} failed to load into memory", 500)
+
+    save_loaded_model(model)
+    update_load_job(job, state="ready", progress=100.0)
+    return backend
 
-# Check if a model is loaded using /api/ps
-def is_model_loaded(model):
+def _run_load_job(job, backend):
     try:
-        response = requests.get(f"{OLLAMA_SERVER}/api/ps", timeout=10)
-        logger.debug(f"Ollama /api/ps response: {response.status_code} - {response.text}")
-        if response.status_code != 200:
-            logger.error(f"Failed to check running models: {response.status_code} - {response.text}")
-            return False
-        running_models = [m['name'] for m in response.json().get('models', [])]
-        return model in running_models
+        run_load_pipeline(job["model"], job, backend)
+    except ApiError as e:
+        update_load_job(job, state="failed", error=e.payload["error"])
     except requests.Timeout:
-        logger.error(f"Timeout checking running models for {model}")
-        return False
-    except requests.RequestException as e:
-        logger.error(f"Network error checking running models for {model}: {str(e)}")
-        return False
+        logger.error("Timeout loading model %s", job['model'])
+        update_load_job(job, state="failed", error="Request to Ollama timed out")
     except Exception as e:
-        logger.error(f"Error checking running models for {model}: {str(e)}")
-        return False
+        logger.error("Unexpected error loading model %s: %s", job['model'], e)
+        update_load_job(job, state="failed", error=str(e))
+
+def start_load_job(model, backend=None):
+    """Starts loading model (onto backend, or one the router picks) in the background
+    and returns a snapshot of the job.
+
+    A load already in progress for the same model is reused instead of starting another.
+    """
+    now = time.time()
+    with _load_jobs_lock:
+        for job_id, job in list(load_jobs.items()):
+            if job["state"] in ("ready", "failed") and now - job["updated_at"] > LOAD_JOB_RETENTION:
+                del load_jobs[job_id]
+        for job in load_jobs.values():
+            if (job["model"] == model and job["state"] not in ("ready", "failed")
+                    and (backend is None or job["backend"] == backend.name)):
+                return dict(job)
+        job = {
+            "id": uuid.uuid4().hex,
+            "model": model,
+            "backend": backend.name if backend else None,
+            "state": "pending",
+            "detail": None,
+            "progress": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        load_jobs[job["id"]] = job
+        snapshot = dict(job)
+    threading.Thread(target=_run_load_job, args=(job, backend), daemon=True).start()
+    return snapshot
+
+def get_load_job(job_id):
+    with _load_jobs_lock:
+        job = load_jobs.get(job_id)
+        return dict(job) if job else None
+
+def unload_model(model, backend):
+    """Unloads a model from backend with keep_alive=0 and waits for it to leave /api/ps; returns whether it did."""
+    stop_response = backend.post(
+        "/api/generate",
+        {
+            "model": model,
+            "prompt": "",
+            "stream": False,
+            "keep_alive": 0
+        }
+    )
+    logger.debug("Ollama /api/generate stop response: %s - %s", stop_response.status_code, Truncated(stop_response.text))
+    if stop_response.status_code != 200:
+        logger.error("Failed to stop model %s: %s - %s", model, stop_response.status_code, Truncated(stop_response.text))
+        raise ApiError(f"Failed to stop model: {stop_response.text}", 500)
+
+    backend.invalidate()
+    return wait_for_model_state(model, loaded=False, backend=backend)
+
+# Startup and live config reload. Importing this module only defines things;
+# initialize() reads config.json and starts the database, caches and background
+# threads, once per process, when the app is first built or used.
+_init_lock = threading.RLock()
+_initialized_pid = None
+_reload_requested = threading.Event()
+_config_watch_thread = None
+
+# Settings read once at startup; a reload keeps the running value and asks for a restart
+RESTART_KEYS = ('db_path', 'db_busy_timeout', 'db_statement_cache', 'flask_host', 'flask_port', 'flask_debug')
+
+# Callables run after every successful reload (llmapi_asgi uses this to swap its clients)
+reload_hooks = []
+
+def is_initialized():
+    return _initialized_pid == os.getpid()
+
+def configure_services():
+    """Brings the router, caches and background tasks in line with the current config."""
+    configure_router()
+    model_cache.ttl = MODEL_CACHE_TTL
+    scheduler.refresh_limits()
+    init_response_cache()
+    init_context_cache()
+    init_db_maintenance()
+    init_idempotency()
+    init_rate_limiter()
+    router.start_health_checks(config.get('backend_health_interval', 10))
+
+def initialize():
+    """Reads config.json and starts everything the routes need. Safe to call more than once."""
+    global _initialized_pid
+    if is_initialized():
+        return
+    with _init_lock:
+        if is_initialized():
+            return
+        # Log to stderr until config.json says where logs go
+        logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=[logging.StreamHandler()])
+        try:
+            apply_config(read_config())
+            configure_logging(config)
+            atexit.register(stop_logging)
+            init_db()
+            configure_services()
+        except Exception as e:
+            logger.error("Failed to initialize app: %s", e)
+            raise
+        _initialized_pid = os.getpid()
+        start_config_watch()
+        install_reload_signal()
+        warm_up()
+
+def _after_fork():
+    # A child forked from an initialized parent (e.g. gunicorn --preload) must not share
+    # its SQLite connections, sockets or dead threads; initialize() starts over in the child.
+    # Locks the parent's threads may have held at the fork are replaced, never waited on.
+    global _init_lock, _initialized_pid, db, context_cache, db_maintenance, log_listener, _config_watch_thread, \
+        response_cache, rate_limiter, _batch_executor, _batch_executor_lock
+    if _initialized_pid is None:
+        return
+    _init_lock = threading.RLock()
+    model_cache._guard = threading.Lock()
+    model_cache._locks = {}
+    router._lock = threading.Lock()
+    for metric in metrics:
+        metric._lock = threading.Lock()
+    _initialized_pid = None
+    db = None
+    context_cache = None
+    response_cache = None
+    rate_limiter = None
+    _batch_executor = None
+    _batch_executor_lock = threading.Lock()
+    db_maintenance = None
+    log_listener = None
+    _config_watch_thread = None
+    router._health_thread = None
+    router.set_backends([])
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
 
-# Poll Ollama for models
-def poll_ollama_models():
+def warm_up():
+    """Fills the model cache and opens a pooled connection to each backend, in the background."""
+    def warm(backend):
+        models = backend.available_models(refresh=True)
+        backend.running_models(refresh=True)
+        logger.info("Backend %s ready (%s models)", backend.name, len(models))
+    for backend in router.backends:
+        threading.Thread(target=warm, args=(backend,), name="warm-up", daemon=True).start()
+
+def reload_config():
+    """Re-reads config.json and applies it to the running process.
+
+    An invalid file is logged and ignored, leaving the current settings in place.
+    Returns whether the new config was applied.
+    """
     try:
-        response = requests.get(f"{OLLAMA_SERVER}/api/tags", timeout=10)
-        logger.debug(f"Ollama /api/tags response: {response.status_code} - {response.text}")
-        if response.status_code == 200:
-            result = response.json()
-            models = [model['name'] for model in result.get('models', [])]
-            logger.info(f"Polled {len(models)} models: {models}")
-            return models
-        else:
-            logger.error(f"Failed to poll models: {response.status_code} - {response.text}")
-            return []
-    except requests.Timeout:
-        logger.error("Timeout polling Ollama models")
-        return []
-    except requests.RequestException as e:
-        logger.error(f"Network error polling Ollama models: {str(e)}")
-        return []
+        new_config = dict(read_config(strict=True))
     except Exception as e:
-        logger.error(f"Error polling Ollama models: {str(e)}")
-        return []
+        logger.warning("Config reload failed, keeping the current settings: %s", e)
+        return False
+    with _init_lock:
+        for key in RESTART_KEYS:
+            if new_config.get(key) != config.get(key):
+                logger.warning("%s changed; restart to apply it", key)
+                if key in config:
+                    new_config[key] = config[key]
+                else:
+                    new_config.pop(key, None)
+        apply_config(new_config)
+        configure_logging(config)
+        configure_services()
+    for hook in list(reload_hooks):
+        try:
+            hook()
+        except Exception as e:
+            logger.error("Config reload hook failed: %s", e)
+    logger.info("Config reloaded from %s", config_path)
+    return True
 
-def clean_response(response_text):
-    """Removes <think> tags and cleans up response."""
+def _config_stamp():
     try:
-        response_text = re.sub(r"<think>.*?</think>", "", response_text, flags=re.DOTALL)
-        response_text = re.sub(r"<think>|</think>", "", response_text)
-        return response_text.strip()
-    except Exception as e:
-        logger.error(f"Error cleaning response: {e}")
-        return response_text
+        stat = os.stat(config_path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
 
-# Initialize database at startup
-try:
-    init_db()
-except Exception as e:
-    logger.error(f"Failed to initialize app: {e}")
-    raise
+def start_config_watch():
+    """Reloads config.json when it changes (polled every config_watch_interval seconds) or on SIGHUP."""
+    global _config_watch_thread
+    if _config_watch_thread is None:
+        _config_watch_thread = threading.Thread(target=_watch_config, name="config-watch", daemon=True)
+        _config_watch_thread.start()
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        data = request.json
-        logger.debug(f"Received chat request: {data}")
-        user_id = data.get("user_id", "default")
-        user_input = data.get("message", "").strip()
-        use_context = data.get("use_context", USE_CONTEXT)
-        model = data.get("model")
+def _watch_config():
+    stamp = _config_stamp()
+    while True:
+        interval = config.get('config_watch_interval', 2)
+        # With polling off (0) only SIGHUP triggers a reload
+        requested = _reload_requested.wait(interval if interval > 0 else None)
+        _reload_requested.clear()
+        current = _config_stamp()
+        if requested or (interval > 0 and current != stamp):
+            stamp = current
+            reload_config()
 
-        if not user_input:
-            logger.warning("No message provided in request")
-            return jsonify({"error": "Message is required"}), 400
-        if not user_id or not isinstance(user_id, str) or len(user_id) > 100:
-            logger.warning(f"Invalid user_id: {user_id}")
-            return jsonify({"error": "Invalid or missing user_id"}), 400
+def request_reload(*_):
+    """Asks the config watcher to reload now; also the SIGHUP handler."""
+    _reload_requested.set()
 
-        # If no model specified, try to use the currently loaded model or a default
-        if not model:
-            model = get_loaded_model()
-            if not model:
-                # Fallback to first available model from /api/tags
-                available_models = poll_ollama_models()
-                if available_models:
-                    model = available_models[0]
-                    logger.info(f"No model loaded; using first available model: {model}")
-                else:
-                    logger.warning("No model specified and no models available")
-                    return jsonify({"error": "Model is required and no models are available"}), 400
-            else:
-                logger.info(f"No model specified; using loaded model: {model}")
+def install_reload_signal():
+    # Signal handlers can only be installed from the main thread
+    if not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGHUP, request_reload)
+    return True
 
-        # Verify model exists via /api/tags
-        models = poll_ollama_models()
-        if model not in models:
-            logger.warning(f"Model {model} not found in available models")
-            return jsonify({"error": f"Model {model} not found"}), 400
-
-        previous_messages = load_context(user_id) if use_context else []
-        logger.debug(f"Context for user {user_id}: {previous_messages}")
-
-        messages = previous_messages + [{"role": "user", "content": user_input}]
-
-        response = requests.post(
-            f"{OLLAMA_SERVER}/api/chat",
-            json={
-                "model": model,
-                "messages": messages,
-                "stream": False,
-                "keep_alive": -1
-            },
-            timeout=60
-        )
+def wants_refresh():
+    return request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
 
-        logger.debug(f"Ollama /api/chat response: {response.status_code} - {response.text}")
-        if response.status_code != 200:
-            logger.error(f"Ollama chat request failed: {response.status_code} - {response.text}")
-            return jsonify({
-                "error": "Failed to get response from Ollama",
-                "status": response.status_code,
-                "response": response.text
-            }), 500
+def backends_running(model, name=None):
+    """The backends (or just the named one) that have model loaded."""
+    backends = [router.get(name)] if name else router.backends
+    return [backend for backend in backends if is_model_loaded(model, backend=backend)]
 
-        try:
-            result = response.json()
-        except ValueError as e:
-            logger.error(f"Failed to parse Ollama response as JSON: {e}")
-            return jsonify({"error": "Invalid response from Ollama server"}), 500
+def unload_everywhere(model, backends):
+    """Unloads model from each backend; returns the names of backends it would not leave."""
+    return [backend.name for backend in backends if not unload_model(model, backend)]
 
-        ai_response = result.get("message", {}).get("content", "")
+def forget_loaded_model(model):
+    """Clears the stored loaded model if it is model and no backend still runs it."""
+    if model == get_loaded_model() and not is_model_loaded(model):
+        save_loaded_model(None)
 
-        if not ai_response:
-            logger.warning("No content in Ollama response")
-            return jsonify({"error": "No response content from AI"}), 500
+def stop_model_everywhere(model, backend=None):
+    """Unloads model from the named backend, or from every backend running it.
 
-        cleaned_response = clean_response(ai_response)
-        logger.debug(f"Cleaned response: {cleaned_response}")
+    Shared by the Flask and ASGI /stop-model routes: returns the success payload,
+    raises ApiError otherwise.
+    """
+    # Verify model exists via /api/tags
+    models = poll_ollama_models()
+    if model not in models:
+        logger.warning("Model %s not found in available models", model)
+        raise ApiError(f"Model {model} not found")
+
+    # Check if model is loaded; without a backend it is unloaded everywhere it runs
+    backends = backends_running(model, backend)
+    if not backends:
+        logger.info("Model %s is not loaded", model)
+        forget_loaded_model(model)
+        return {"success": True, "message": f"Model {model} is not loaded"}
+
+    # Unload model with a dummy generate call and keep_alive=0, then wait for /api/ps to drop it
+    logger.info("Unloading model %s", model)
+    failed = unload_everywhere(model, backends)
+    if failed:
+        logger.error("Model %s still loaded after unload attempt", model)
+        raise ApiError(f"Failed to unload model {model}", 500, backends=failed)
+    forget_loaded_model(model)
+    return {"success": True, "message": f"Model {model} stopped/unloaded successfully",
+            "backends": [backend.name for backend in backends]}
+
+def stop_current_model():
+    """Unloads the stored loaded model everywhere; shared by both /stop-loaded-model routes."""
+    model = get_loaded_model()
+    if not model:
+        logger.info("No model currently loaded")
+        return {"success": True, "message": "No model currently loaded"}
+
+    backends = backends_running(model)
+    if not backends:
+        logger.info("Model %s is not loaded", model)
+        save_loaded_model(None)
+        return {"success": True, "message": f"Model {model} is not loaded"}
+
+    logger.info("Unloading currently loaded model %s", model)
+    failed = unload_everywhere(model, backends)
+    if failed:
+        logger.error("Model %s still loaded after unload attempt", model)
+        raise ApiError(f"Failed to unload model {model}", 500, backends=failed)
+    save_loaded_model(None)
+    return {"success": True, "message": f"Model {model} stopped/unloaded successfully",
+            "backends": [backend.name for backend in backends]}
+
+@api.route('/chat', methods=['POST'])
+def chat():
+    try:
+        g.timings = start_request_timing()
+        data = request.json
+        logger.debug("Received chat request: %s", Truncated(data))
+        plan = prepare_chat(data)
+        stream = wants_stream(data, request.headers.get("Accept", ""))
+
+        # A retry of a request that is running (or kept) gets that request's reply
+        original = claim_chat(plan, request.headers.get("Idempotency-Key"))
+        if original is not None:
+            replay = replay_plan(original, plan)
+            if stream:
+                frames = ChatStreamRelay(replay, cached=original.cached, save=False).replay(original.reply)
+                return Response(frames, mimetype="text/event-stream", headers={**SSE_HEADERS, **REPLAYED_HEADERS})
+            return jsonify(chat_response_payload(replay, original.reply, cached=original.cached)), 200, REPLAYED_HEADERS
+
+        try:
+            # Cache hits skip the queue and the upstream call entirely
+            cached = cached_reply(plan)
+            if cached is not None:
+                if stream:
+                    frames = ChatStreamRelay(plan, cached=True).replay(cached)
+                    return Response(frames, mimetype="text/event-stream", headers=SSE_HEADERS)
+                complete_chat(plan, cached, cached=True)
+                return jsonify(chat_response_payload(plan, cached, cached=True))
 
-        new_messages = previous_messages + [{"role": "user", "content": user_input}, {"role": "assistant", "content": ai_response}]
+            with timed_stage("queue_wait"):
+                ticket = scheduler.acquire(plan["model"], plan["user_id"])
+            if stream:
+                try:
+                    # The stream releases the claim when it ends
+                    return stream_chat(plan, ticket)
+                except Exception:
+                    scheduler.release(ticket)
+                    raise
 
-        if use_context:
-            save_context(user_id, new_messages)
+            try:
+                with router.acquire(plan["model"], plan["user_id"]) as backend, timed_stage("upstream"):
+                    plan["backend"] = backend
+                    response = backend.post("/api/chat", ollama_chat_payload(plan, stream=False))
+            finally:
+                scheduler.release(ticket)
+            result = parse_chat_result(response.status_code, response.content)
+            ai_response = result["message"]["content"]
 
-        save_loaded_model(model)
-        return jsonify({
-            "choices": [{"message": {"content": cleaned_response}}],
-            "context": new_messages if use_context else []
-        })
+            complete_chat(plan, ai_response)
+            return jsonify(chat_response_payload(plan, ai_response))
+        except BaseException:
+            release_claim(plan)
+            raise
 
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
     except requests.Timeout:
         logger.error("Request to Ollama timed out")
         return jsonify({"error": "Request timed out. Please try again later."}), 500
     except requests.RequestException as e:
-        logger.error(f"Network error: {str(e)}")
+        logger.error("Network error: %s", e)
+        return jsonify({"error": f"Network error: {str(e)}"}), 500
+    except Exception as e:
+        logger.error("Unexpected error in chat: %s", e)
+        return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
+
+@api.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    try:
+        batch = ChatBatch(parse_batch(request.json))
+        return Response(iter(batch), mimetype="application/x-ndjson")
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
+    except requests.RequestException as e:
+        logger.error("Network error: %s", e)
         return jsonify({"error": f"Network error: {str(e)}"}), 500
     except Exception as e:
-        logger.error(f"Unexpected error in chat: {str(e)}")
+        logger.error("Unexpected error in chat batch: %s", e)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
-@app.route('/models', methods=['GET'])
+@api.before_app_request
+def reset_request_timing():
+    # Worker threads serve many requests; a route that does not start its own timing
+    # must not add its stages to the list left behind by an earlier /chat
+    _request_timings.set(None)
+
+@api.after_app_request
+def record_request(response):
+    HTTP_REQUESTS.inc(method=request.method, path=request.url_rule.rule if request.url_rule else "unmatched",
+                      status=response.status_code)
+    timings = g.get('timings')
+    if SERVER_TIMING and timings:
+        response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@api.route('/admin/db-stats', methods=['GET'])
+def admin_db_stats():
+    try:
+        check_admin_token(admin_token_from(request.headers.get('Authorization'), request.headers.get('X-Admin-Token')))
+        return jsonify(db_stats(top=request.args.get('top', 10, type=int)))
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
+    except Exception as e:
+        logger.error("Error getting database stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/queue', methods=['GET'])
+def queue_stats():
+    try:
+        return jsonify({"models": scheduler.stats()})
+    except Exception as e:
+        logger.error("Error getting queue stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/models', methods=['GET'])
 def list_models():
     try:
-        # Always poll for fresh list; ignore refresh param for simplicity
-        models = poll_ollama_models()
-        logger.debug(f"Returning models: {models}")
+        # Served from the model cache; ?refresh=1 forces a fresh poll
+        models = poll_ollama_models(refresh=wants_refresh())
+        logger.debug("Returning models: %s", Truncated(models))
         return jsonify({"models": models})
     except Exception as e:
-        logger.error(f"Error listing models: {e}")
+        logger.error("Error listing models: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/loaded-model', methods=['GET'])
+@api.route('/loaded-model', methods=['GET'])
 def loaded_model():
     try:
-        model = get_loaded_model()
-        logger.debug(f"Returning loaded model: {model}")
-        return jsonify({"loaded_model": model})
+        refresh = wants_refresh()
+        model = get_loaded_model(refresh=refresh)
+        logger.debug("Returning loaded model: %s", model)
+        return jsonify({"loaded_model": model, "backends": router.stats(refresh=refresh)})
     except Exception as e:
-        logger.error(f"Error getting loaded model: {e}")
+        logger.error("Error getting loaded model: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/load-model', methods=['POST'])
+@api.route('/load-model', methods=['POST'])
 def load_model():
+    model = None
     try:
         data = request.json
         model = data.get("model")
@@ -347,166 +3620,102 @@ def load_model():
             logger.warning("No model provided in load request")
             return jsonify({"error": "Model name is required"}), 400
 
-        # Verify model exists via /api/tags; pull if not
-        models = poll_ollama_models()
-        if model not in models:
-            logger.info(f"Model {model} not found locally; pulling...")
-            pull_response = requests.post(
-                f"{OLLAMA_SERVER}/api/pull",
-                json={"name": model, "stream": False},
-                timeout=600
-            )
-            if pull_response.status_code != 200:
-                logger.error(f"Failed to pull model {model}: {pull_response.status_code} - {pull_response.text}")
-                return jsonify({"error": f"Failed to pull model: {pull_response.text}"}), 500
-            # Repoll after pull
-            models = poll_ollama_models()
-            if model not in models:
-                return jsonify({"error": f"Model {model} not available after pull"}), 500
-
-        # Load model into memory with a dummy generate call
-        logger.info(f"Loading model {model} into memory")
-        load_response = requests.post(
-            f"{OLLAMA_SERVER}/api/generate",
-            json={
-                "model": model,
-                "prompt": "",
-                "stream": False,
-                "keep_alive": -1
-            },
-            timeout=60
-        )
-        if load_response.status_code != 200:
-            logger.error(f"Failed to load model {model}: {load_response.status_code} - {load_response.text}")
-            return jsonify({"error": f"Failed to load model: {load_response.text}"}), 500
+        backend = router.get(data["backend"]) if data.get("backend") else None
 
-        # Verify model is loaded
-        time.sleep(1)  # Give time for loading
-        if not is_model_loaded(model):
-            logger.error(f"Model {model} not listed in /api/ps after loading")
-            return jsonify({"error": f"Model {model} failed to load into memory"}), 500
+        # "async": true returns a job id at once; poll /load-model/<job_id> for progress
+        if data.get("async"):
+            job = start_load_job(model, backend)
+            return jsonify({"success": True, "job_id": job["id"], "status_url": f"/load-model/{job['id']}", "job": job}), 202
 
-        save_loaded_model(model)
-        return jsonify({"success": True, "message": f"Model {model} loaded successfully"})
+        backend = run_load_pipeline(model, backend=backend)
+        return jsonify({"success": True, "message": f"Model {model} loaded successfully", "backend": backend.name})
 
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
     except requests.Timeout:
-        logger.error(f"Timeout loading model {model}")
+        logger.error("Timeout loading model %s", model)
         return jsonify({"error": "Request to Ollama timed out"}), 500
     except requests.RequestException as e:
-        logger.error(f"Network error loading model {model}: {str(e)}")
+        logger.error("Network error loading model %s: %s", model, e)
         return jsonify({"error": f"Network error: {str(e)}"}), 500
     except Exception as e:
-        logger.error(f"Unexpected error loading model {model}: {str(e)}")
+        logger.error("Unexpected error loading model %s: %s", model, e)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
-@app.route('/stop-model', methods=['POST'])
+@api.route('/load-model/<job_id>', methods=['GET'])
+def load_model_status(job_id):
+    job = get_load_job(job_id)
+    if not job:
+        return jsonify({"error": f"Load job {job_id} not found"}), 404
+    return jsonify(job)
+
+@api.route('/stop-model', methods=['POST'])
 def stop_model():
+    model = None
     try:
         data = request.json
         model = data.get("model")
         if not model:
             logger.warning("No model provided in stop request")
             return jsonify({"error": "Model name is required"}), 400
+        return jsonify(stop_model_everywhere(model, data.get("backend")))
 
-        # Verify model exists via /api/tags
-        models = poll_ollama_models()
-        if model not in models:
-            logger.warning(f"Model {model} not found in available models")
-            return jsonify({"error": f"Model {model} not found"}), 400
-
-        # Check if model is loaded
-        if not is_model_loaded(model):
-            logger.info(f"Model {model} is not loaded")
-            if model == get_loaded_model():
-                save_loaded_model(None)
-            return jsonify({"success": True, "message": f"Model {model} is not loaded"})
-
-        # Unload model with a dummy generate call and keep_alive=0
-        logger.info(f"Unloading model {model}")
-        stop_response = requests.post(
-            f"{OLLAMA_SERVER}/api/generate",
-            json={
-                "model": model,
-                "prompt": "",
-                "stream": False,
-                "keep_alive": 0
-            },
-            timeout=60
-        )
-        logger.debug(f"Ollama /api/generate stop response: {stop_response.status_code} - {stop_response.text}")
-        if stop_response.status_code != 200:
-            logger.error(f"Failed to stop model {model}: {stop_response.status_code} - {stop_response.text}")
-            return jsonify({"error": f"Failed to stop model: {stop_response.text}"}), 500
-
-        # Verify model is unloaded
-        time.sleep(2)  # Give time for unloading
-        if not is_model_loaded(model):
-            if model == get_loaded_model():
-                save_loaded_model(None)
-            return jsonify({"success": True, "message": f"Model {model} stopped/unloaded successfully"})
-
-        logger.error(f"Model {model} still loaded after unload attempt")
-        return jsonify({"error": f"Failed to unload model {model}"}), 500
-
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
     except requests.Timeout:
-        logger.error(f"Timeout stopping model {model}")
+        logger.error("Timeout stopping model %s", model)
         return jsonify({"error": "Request to Ollama timed out"}), 500
     except requests.RequestException as e:
-        logger.error(f"Network error stopping model {model}: {str(e)}")
+        logger.error("Network error stopping model %s: %s", model, e)
         return jsonify({"error": f"Network error: {str(e)}"}), 500
     except Exception as e:
-        logger.error(f"Error stopping model: {str(e)}")
+        logger.error("Error stopping model: %s", e)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
-@app.route('/stop-loaded-model', methods=['POST'])
+@api.route('/stop-loaded-model', methods=['POST'])
 def stop_loaded_model():
     try:
-        model = get_loaded_model()
-        if not model:
-            logger.info("No model currently loaded")
-            return jsonify({"success": True, "message": "No model currently loaded"})
-
-        # Check if model is loaded
-        if not is_model_loaded(model):
-            logger.info(f"Model {model} is not loaded")
-            save_loaded_model(None)
-            return jsonify({"success": True, "message": f"Model {model} is not loaded"})
-
-        # Unload model with a dummy generate call and keep_alive=0
-        logger.info(f"Unloading currently loaded model {model}")
-        stop_response = requests.post(
-            f"{OLLAMA_SERVER}/api/generate",
-            json={
-                "model": model,
-                "prompt": "",
-                "stream": False,
-                "keep_alive": 0
-            },
-            timeout=60
-        )
-        logger.debug(f"Ollama /api/generate stop response: {stop_response.status_code} - {stop_response.text}")
-        if stop_response.status_code != 200:
-            logger.error(f"Failed to stop model {model}: {stop_response.status_code} - {stop_response.text}")
-            return jsonify({"error": f"Failed to stop model: {stop_response.text}"}), 500
-
-        # Verify model is unloaded
-        time.sleep(2)  # Give time for unloading
-        if not is_model_loaded(model):
-            save_loaded_model(None)
-            return jsonify({"success": True, "message": f"Model {model} stopped/unloaded successfully"})
-
-        logger.error(f"Model {model} still loaded after unload attempt")
-        return jsonify({"error": f"Failed to unload model {model}"}), 500
+        return jsonify(stop_current_model())
 
+    except ApiError as e:
+        return jsonify(e.payload), e.status, e.headers
     except requests.Timeout:
         logger.error("Timeout stopping loaded model")
         return jsonify({"error": "Request to Ollama timed out"}), 500
     except requests.RequestException as e:
-        logger.error(f"Network error stopping loaded model: {str(e)}")
+        logger.error("Network error stopping loaded model: %s", e)
         return jsonify({"error": f"Network error: {str(e)}"}), 500
     except Exception as e:
-        logger.error(f"Error stopping loaded model: {str(e)}")
+        logger.error("Error stopping loaded model: %s", e)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+@api.before_app_request
+def ensure_initialized():
+    initialize()
+
+def create_app():
+    """Builds the Flask app, initializing this process first if needed.
+
+    Use it as the WSGI entry point (`gunicorn 'llmapi:create_app()'`); `llmapi:app`
+    also works and builds the app on first access.
+    """
+    initialize()
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    CORS(app)
+    app.register_blueprint(api)
+    return app
+
+_app = None
+
+def __getattr__(name):
+    global _app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _init_lock:
+        if _app is None:
+            _app = create_app()
+    return _app
+
 if __name__ == '__main__':
-    app.run(host=flask_host, port=flask_port, debug=flask_debug)
+    create_app().run(host=flask_host, port=flask_port, debug=flask_debug)
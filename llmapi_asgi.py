@@ -0,0 +1,542 @@
+"""Asyncio (ASGI) entry point for the chat API.
+
+Serves the same routes as the Flask app in llmapi.py, but chat calls to Ollama go
+through a non-blocking httpx client and database work runs in worker threads, so a
+slow generation holds a coroutine rather than a whole worker. Model loading and
+unloading run llmapi's own helpers in worker threads, so both apps behave the same.
+Run it with:
+
+    uvicorn llmapi_asgi:app --host 0.0.0.0 --port 6000
+
+The Flask app (llmapi:app) keeps working unchanged; both share config.json, the
+context database and the model cache. Config reloads (SIGHUP or an edit to
+config.json) apply here too: clients for replaced backends are swapped on next use.
+"""
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+import httpx
+import requests
+
+import llmapi
+from llmapi import JSON_HEADERS, ApiError, Truncated, json_dumps, json_loads, logger
+
+# One async client per Ollama backend: backend name -> (settings key, client)
+clients = {}
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+# What llmapi.Backend counts as a failed backend (requests.ConnectionError there)
+BACKEND_FAILURES = (httpx.NetworkError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+def create_client(backend):
+    return httpx.AsyncClient(
+        base_url=backend.base_url,
+        timeout=httpx.Timeout(backend.read_timeout, connect=backend.connect_timeout, pool=None),
+        limits=httpx.Limits(
+            max_connections=llmapi.config.get('asgi_max_connections', 500),
+            max_keepalive_connections=backend.settings.get('pool_size', 10)
+        ),
+        # httpx only retries failed connection attempts, never a sent request
+        transport=httpx.AsyncHTTPTransport(retries=backend.settings.get('retries', 2))
+    )
+
+def client_for(backend):
+    # A config reload replaces the Backend object when its URL or client settings change
+    key = (backend, llmapi.config.get('asgi_max_connections', 500))
+    entry = clients.get(backend.name)
+    if entry is None or entry[0] != key:
+        if entry is not None:
+            asyncio.get_running_loop().create_task(retire_client(entry[0][0], entry[1]))
+        entry = clients[backend.name] = (key, create_client(backend))
+    return entry[1]
+
+async def retire_client(backend, client):
+    """Closes a replaced client once requests already using it have had time to finish."""
+    while backend.in_flight:
+        await asyncio.sleep(1)
+    await asyncio.sleep(backend.read_timeout)
+    await client.aclose()
+
+async def send_upstream(backend, method, path, stream=False, **kwargs):
+    """Sends a request to backend with the bookkeeping llmapi.Backend does for the Flask app.
+
+    Records the upstream latency (up to the response headers) and status, and
+    counts connection failures against the backend. With stream=True the caller
+    must read or aclose() the response.
+    """
+    client = client_for(backend)
+    start = time.perf_counter()
+    try:
+        response = await client.send(client.build_request(method, path, **kwargs), stream=stream)
+    except httpx.HTTPError as e:
+        llmapi.UPSTREAM_REQUESTS.inc(path=path, status="error")
+        if isinstance(e, BACKEND_FAILURES):
+            backend.record_failure()
+        raise
+    llmapi.UPSTREAM_SECONDS.observe(time.perf_counter() - start, path=path)
+    llmapi.UPSTREAM_REQUESTS.inc(path=path, status=response.status_code)
+    backend.record_success()
+    return response
+
+def header(scope, name):
+    name = name.encode()
+    for key, value in scope.get("headers", []):
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return ""
+
+def wants_refresh(scope):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return query.get("refresh", [""])[0].lower() in ("1", "true", "yes")
+
+async def read_json(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = b"".join(chunks)
+    if not body:
+        return None
+    try:
+        return json_loads(body)
+    except ValueError:
+        raise ApiError("Request body is not valid JSON")
+
+async def send_json(send, payload, status=200, headers=None):
+    body = json_dumps(payload)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *[(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+            *CORS_HEADERS
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+async def acquire_slot(model, user_id):
+    """Waits for a scheduler slot without tying up a thread; the caller must release it."""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+    scheduler = llmapi.scheduler
+    ticket = scheduler.enqueue(model, user_id, lambda: loop.call_soon_threadsafe(_resolve, granted))
+    if ticket.granted:
+        return ticket
+    max_wait = scheduler.limits_for(model)["max_wait"]
+    try:
+        await asyncio.wait_for(granted, max_wait)
+    except asyncio.TimeoutError:
+        scheduler.release(ticket)
+        logger.warning("Request for model %s waited %ss in queue; giving up", model, max_wait)
+        raise ApiError(f"Timed out waiting for model {model}", 503, headers={"Retry-After": "1"})
+    except BaseException:
+        scheduler.release(ticket)
+        raise
+    return ticket
+
+async def claim_chat(plan, idempotency_key):
+    """llmapi.claim_chat() that waits for a running identical request without holding a thread."""
+    loop = asyncio.get_running_loop()
+    while True:
+        original = await asyncio.to_thread(llmapi.claim_chat, plan, idempotency_key, False)
+        if original is None:
+            return None
+        finished = loop.create_future()
+        original.store.add_done_callback(original, lambda: loop.call_soon_threadsafe(_resolve, finished))
+        await finished
+        if original.reply is not None:
+            return original
+        logger.info("Earlier identical request for user %s failed; running this one", plan["user_id"])
+
+async def send_sse(send, frames, headers=None):
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            *[(k.lower().encode(), v.encode()) for k, v in {**llmapi.SSE_HEADERS, **(headers or {})}.items()],
+            *CORS_HEADERS
+        ]
+    })
+    await send({"type": "http.response.body", "body": "".join(frames).encode()})
+
+async def stream_chat(send, plan):
+    """Relays Ollama's NDJSON chunks to the client as SSE and saves the transcript at the end."""
+    relay = llmapi.ChatStreamRelay(plan)
+    payload = json_dumps(llmapi.ollama_chat_payload(plan, stream=True))
+    response = await send_upstream(plan["backend"], "POST", "/api/chat", stream=True, content=payload, headers=JSON_HEADERS)
+    try:
+        if response.status_code != 200:
+            body = (await response.aread()).decode(errors="replace")
+            logger.error("Ollama chat stream request failed: %s - %s", response.status_code, Truncated(body))
+            raise ApiError("Failed to get response from Ollama", 500, status=response.status_code, response=body)
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                *[(k.lower().encode(), v.encode()) for k, v in llmapi.SSE_HEADERS.items()],
+                *CORS_HEADERS
+            ]
+        })
+        try:
+            async for line in response.aiter_lines():
+                if not relay.done:
+                    for frame in relay.feed_line(line):
+                        await send({"type": "http.response.body", "body": frame.encode(), "more_body": True})
+                elif relay.failed:
+                    break
+                # Past the final chunk, read on to the end of the body so the
+                # connection goes back to the pool instead of being dropped
+            frames = await asyncio.to_thread(relay.finish)
+        except httpx.HTTPError as e:
+            logger.error("Network error while streaming: %s", e)
+            frames = relay.error(f"Network error: {str(e)}")
+        await send({"type": "http.response.body", "body": "".join(frames).encode()})
+    finally:
+        await response.aclose()
+
+def timing_headers(timings):
+    if llmapi.SERVER_TIMING and timings:
+        return {"Server-Timing": llmapi.server_timing_header(timings)}
+    return None
+
+async def run_chat(send, plan, stream, timings):
+    # Cache hits skip the queue and the upstream call entirely
+    cached = await asyncio.to_thread(llmapi.cached_reply, plan)
+    if cached is not None:
+        if stream:
+            relay = llmapi.ChatStreamRelay(plan, cached=True)
+            return await send_sse(send, await asyncio.to_thread(relay.replay, cached))
+        await asyncio.to_thread(llmapi.complete_chat, plan, cached, True)
+        payload = llmapi.chat_response_payload(plan, cached, cached=True)
+        return await send_json(send, payload, headers=timing_headers(timings))
+
+    with llmapi.timed_stage("queue_wait"):
+        ticket = await acquire_slot(plan["model"], plan["user_id"])
+    lease = None
+    try:
+        lease = await asyncio.to_thread(llmapi.router.acquire, plan["model"], plan["user_id"])
+        plan["backend"] = lease.backend
+        if stream:
+            return await stream_chat(send, plan)
+        with llmapi.timed_stage("upstream"):
+            response = await send_upstream(
+                lease.backend, "POST", "/api/chat",
+                content=json_dumps(llmapi.ollama_chat_payload(plan, stream=False)), headers=JSON_HEADERS)
+    finally:
+        if lease is not None:
+            lease.release()
+        llmapi.scheduler.release(ticket)
+    result = llmapi.parse_chat_result(response.status_code, response.content)
+    ai_response = result["message"]["content"]
+
+    await asyncio.to_thread(llmapi.complete_chat, plan, ai_response)
+    payload = llmapi.chat_response_payload(plan, ai_response)
+    await send_json(send, payload, headers=timing_headers(timings))
+
+async def chat(scope, receive, send):
+    timings = llmapi.start_request_timing()
+    try:
+        data = await read_json(receive)
+        logger.debug("Received chat request: %s", Truncated(data))
+        plan = await asyncio.to_thread(llmapi.prepare_chat, data)
+        stream = llmapi.wants_stream(data, header(scope, "accept"))
+
+        # A retry of a request that is running (or kept) gets that request's reply
+        original = await claim_chat(plan, header(scope, "idempotency-key"))
+        if original is not None:
+            replay = llmapi.replay_plan(original, plan)
+            if stream:
+                relay = llmapi.ChatStreamRelay(replay, cached=original.cached, save=False)
+                return await send_sse(send, relay.replay(original.reply), llmapi.REPLAYED_HEADERS)
+            payload = llmapi.chat_response_payload(replay, original.reply, cached=original.cached)
+            return await send_json(send, payload, headers={**llmapi.REPLAYED_HEADERS, **(timing_headers(timings) or {})})
+
+        try:
+            await run_chat(send, plan, stream, timings)
+        finally:
+            # A no-op once complete_chat() has recorded the reply
+            llmapi.release_claim(plan)
+
+    except ApiError as e:
+        await send_json(send, e.payload, e.status, e.headers)
+    except httpx.TimeoutException:
+        logger.error("Request to Ollama timed out")
+        await send_json(send, {"error": "Request timed out. Please try again later."}, 500)
+    except httpx.HTTPError as e:
+        logger.error("Network error: %s", e)
+        await send_json(send, {"error": f"Network error: {str(e)}"}, 500)
+    except Exception as e:
+        logger.error("Unexpected error in chat: %s", e)
+        await send_json(send, {"error": f"Unexpected error: {str(e)}"}, 500)
+
+async def chat_batch(scope, receive, send):
+    # Batch items already run on their own thread pool, so the batch reuses the
+    # blocking runner from llmapi and only hands its lines over to the event loop
+    try:
+        data = await read_json(receive)
+        batch = await asyncio.to_thread(llmapi.ChatBatch, llmapi.parse_batch(data))
+    except ApiError as e:
+        return await send_json(send, e.payload, e.status, e.headers)
+    except Exception as e:
+        logger.error("Unexpected error in chat batch: %s", e)
+        return await send_json(send, {"error": f"Unexpected error: {str(e)}"}, 500)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"application/x-ndjson"), *CORS_HEADERS]
+    })
+    lines = iter(batch)
+    try:
+        while True:
+            line = await asyncio.to_thread(next, lines, None)
+            if line is None:
+                break
+            await send({"type": "http.response.body", "body": line, "more_body": True})
+    finally:
+        await asyncio.to_thread(lines.close)
+    await send({"type": "http.response.body", "body": b""})
+
+async def metrics_endpoint(scope, receive, send):
+    body = llmapi.render_metrics().encode()
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/plain; version=0.0.4"), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def admin_db_stats(scope, receive, send):
+    try:
+        llmapi.check_admin_token(llmapi.admin_token_from(header(scope, "authorization"), header(scope, "x-admin-token")))
+        try:
+            top = int(parse_qs(scope.get("query_string", b"").decode()).get("top", ["10"])[0])
+        except ValueError:
+            top = 10
+        await send_json(send, await asyncio.to_thread(llmapi.db_stats, top))
+    except ApiError as e:
+        await send_json(send, e.payload, e.status, e.headers)
+    except Exception as e:
+        logger.error("Error getting database stats: %s", e)
+        await send_json(send, {"error": str(e)}, 500)
+
+async def queue_stats(scope, receive, send):
+    try:
+        await send_json(send, {"models": llmapi.scheduler.stats()})
+    except Exception as e:
+        logger.error("Error getting queue stats: %s", e)
+        await send_json(send, {"error": str(e)}, 500)
+
+async def list_models(scope, receive, send):
+    try:
+        models = await asyncio.to_thread(llmapi.poll_ollama_models, wants_refresh(scope))
+        logger.debug("Returning models: %s", Truncated(models))
+        await send_json(send, {"models": models})
+    except Exception as e:
+        logger.error("Error listing models: %s", e)
+        await send_json(send, {"error": str(e)}, 500)
+
+async def loaded_model(scope, receive, send):
+    try:
+        refresh = wants_refresh(scope)
+        model = await asyncio.to_thread(llmapi.get_loaded_model, refresh)
+        logger.debug("Returning loaded model: %s", model)
+        backends = await asyncio.to_thread(llmapi.router.stats, refresh)
+        await send_json(send, {"loaded_model": model, "backends": backends})
+    except Exception as e:
+        logger.error("Error getting loaded model: %s", e)
+        await send_json(send, {"error": str(e)}, 500)
+
+async def load_model(scope, receive, send):
+    model = None
+    try:
+        data = await read_json(receive)
+        model = data.get("model")
+        if not model:
+            logger.warning("No model provided in load request")
+            return await send_json(send, {"error": "Model name is required"}, 400)
+
+        backend = llmapi.router.get(data["backend"]) if data.get("backend") else None
+
+        # "async": true returns a job id at once; poll /load-model/<job_id> for progress
+        if data.get("async"):
+            job = await asyncio.to_thread(llmapi.start_load_job, model, backend)
+            return await send_json(send, {
+                "success": True, "job_id": job["id"], "status_url": f"/load-model/{job['id']}", "job": job
+            }, 202)
+
+        # The pull and load are mostly waiting on Ollama; the shared pipeline runs in a
+        # worker thread so pull progress and backend failures are recorded as in Flask
+        backend = await asyncio.to_thread(llmapi.run_load_pipeline, model, None, backend)
+        await send_json(send, {"success": True, "message": f"Model {model} loaded successfully", "backend": backend.name})
+
+    except ApiError as e:
+        await send_json(send, e.payload, e.status, e.headers)
+    except requests.Timeout:
+        logger.error("Timeout loading model %s", model)
+        await send_json(send, {"error": "Request to Ollama timed out"}, 500)
+    except requests.RequestException as e:
+        logger.error("Network error loading model %s: %s", model, e)
+        await send_json(send, {"error": f"Network error: {str(e)}"}, 500)
+    except Exception as e:
+        logger.error("Unexpected error loading model %s: %s", model, e)
+        await send_json(send, {"error": f"Unexpected error: {str(e)}"}, 500)
+
+async def load_model_status(scope, receive, send, job_id):
+    job = llmapi.get_load_job(job_id)
+    if not job:
+        return await send_json(send, {"error": f"Load job {job_id} not found"}, 404)
+    await send_json(send, job)
+
+async def stop_model(scope, receive, send):
+    model = None
+    try:
+        data = await read_json(receive)
+        model = data.get("model")
+        if not model:
+            logger.warning("No model provided in stop request")
+            return await send_json(send, {"error": "Model name is required"}, 400)
+        await send_json(send, await asyncio.to_thread(llmapi.stop_model_everywhere, model, data.get("backend")))
+
+    except ApiError as e:
+        await send_json(send, e.payload, e.status, e.headers)
+    except requests.Timeout:
+        logger.error("Timeout stopping model %s", model)
+        await send_json(send, {"error": "Request to Ollama timed out"}, 500)
+    except requests.RequestException as e:
+        logger.error("Network error stopping model %s: %s", model, e)
+        await send_json(send, {"error": f"Network error: {str(e)}"}, 500)
+    except Exception as e:
+        logger.error("Error stopping model: %s", e)
+        await send_json(send, {"error": f"Unexpected error: {str(e)}"}, 500)
+
+async def stop_loaded_model(scope, receive, send):
+    try:
+        await send_json(send, await asyncio.to_thread(llmapi.stop_current_model))
+
+    except ApiError as e:
+        await send_json(send, e.payload, e.status, e.headers)
+    except requests.Timeout:
+        logger.error("Timeout stopping loaded model")
+        await send_json(send, {"error": "Request to Ollama timed out"}, 500)
+    except requests.RequestException as e:
+        logger.error("Network error stopping loaded model: %s", e)
+        await send_json(send, {"error": f"Network error: {str(e)}"}, 500)
+    except Exception as e:
+        logger.error("Error stopping loaded model: %s", e)
+        await send_json(send, {"error": f"Unexpected error: {str(e)}"}, 500)
+
+# Routes with a trailing path parameter: prefix -> {method: handler(scope, receive, send, param)}
+PARAM_ROUTES = {
+    '/load-model/': {'GET': load_model_status},
+}
+
+ROUTES = {
+    ('/chat', 'POST'): chat,
+    ('/chat/batch', 'POST'): chat_batch,
+    ('/metrics', 'GET'): metrics_endpoint,
+    ('/admin/db-stats', 'GET'): admin_db_stats,
+    ('/queue', 'GET'): queue_stats,
+    ('/models', 'GET'): list_models,
+    ('/loaded-model', 'GET'): loaded_model,
+    ('/load-model', 'POST'): load_model,
+    ('/stop-model', 'POST'): stop_model,
+    ('/stop-loaded-model', 'POST'): stop_loaded_model,
+}
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await asyncio.to_thread(llmapi.initialize)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            # initialize() ran in a worker thread, where it cannot install the SIGHUP handler
+            llmapi.install_reload_signal()
+            # Open a connection to each backend before the first request needs one
+            await asyncio.gather(*(send_upstream(backend, "GET", "/api/version") for backend in llmapi.router.backends),
+                                 return_exceptions=True)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for _, client in list(clients.values()):
+                await client.aclose()
+            clients.clear()
+            if llmapi.context_cache is not None:
+                # uvicorn re-raises SIGTERM after shutdown, so atexit handlers may never run
+                await asyncio.to_thread(llmapi.context_cache.close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] != "http":
+        return await dispatch(scope, receive, send)
+    if not llmapi.is_initialized():
+        # Servers started without lifespan support initialize on the first request
+        await asyncio.to_thread(llmapi.initialize)
+
+    status = {}
+
+    async def send_and_record(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+        await send(message)
+
+    try:
+        await dispatch(scope, receive, send_and_record)
+    finally:
+        path = scope["path"].rstrip('/') or '/'
+        route = path if any(p == path for p, _ in ROUTES) else (
+            next((prefix + '<job_id>' for prefix in PARAM_ROUTES if path.startswith(prefix)), "unmatched"))
+        llmapi.HTTP_REQUESTS.inc(method=scope["method"], path=route, status=status.get("code", 500))
+
+async def dispatch(scope, receive, send):
+    # Clients are created on first use for servers started without lifespan support
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"].rstrip('/') or '/'
+    method = scope["method"]
+    allowed = [m for (p, m) in ROUTES if p == path]
+    if method == 'OPTIONS' and allowed:
+        # CORS preflight, mirroring flask_cors defaults on the Flask app
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                *CORS_HEADERS,
+                (b"access-control-allow-methods", ", ".join(allowed + ['OPTIONS']).encode()),
+                (b"access-control-allow-headers", (header(scope, "access-control-request-headers") or "*").encode()),
+                (b"content-length", b"0")
+            ]
+        })
+        return await send({"type": "http.response.body", "body": b""})
+
+    for prefix, handlers in PARAM_ROUTES.items():
+        param = path[len(prefix):]
+        if path.startswith(prefix) and param and '/' not in param:
+            if method not in handlers:
+                return await send_json(send, {"error": "Method not allowed"}, 405)
+            return await handlers[method](scope, receive, send, param)
+
+    handler = ROUTES.get((path, method))
+    if handler is None:
+        status = 405 if allowed else 404
+        return await send_json(send, {"error": "Method not allowed" if allowed else "Not found"}, status)
+    await handler(scope, receive, send)
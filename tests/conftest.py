@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "bench"))
+
+import llmapi  # noqa: E402
+from fake_ollama import FakeOllama, serve  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_ollama():
+    """A fake Ollama server on a free port, shared by the whole session."""
+    fake = FakeOllama(["llama3:latest", "qwen2:latest"], latency=0.01, tokens_per_second=0,
+                      load_seconds=0.01, pull_seconds=0.01)
+    server = serve("127.0.0.1", 0, fake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake.url = f"http://127.0.0.1:{server.server_port}"
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def config_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp("llmapi")
+    llmapi.config_path = str(path / "config.json")
+    return path
+
+
+@pytest.fixture
+def make_app(fake_ollama, config_dir):
+    """Writes config.json with the given settings and returns an app running on it."""
+    def make(**settings):
+        fake_ollama.latency = 0.01
+        config = {
+            "ollama_server": fake_ollama.url,
+            "db_path": str(config_dir / "user_contexts.db"),
+            "log_path": str(config_dir / "flask.log"),
+            "log_level": "WARNING",
+            "config_watch_interval": 0,
+            "backend_health_interval": 0,
+            "response_cache": {"enabled": False},
+            **settings
+        }
+        with open(llmapi.config_path, "w") as f:
+            json.dump(config, f)
+        if llmapi.is_initialized():
+            assert llmapi.reload_config()
+        return llmapi.create_app()
+    return make
@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+
+import llmapi
+import llmapi_asgi
+
+
+def upstream_count(path):
+    counts = llmapi.UPSTREAM_SECONDS._values.get((path,))
+    return counts[-2] if counts else 0
+
+
+def requests_with_status(path, status):
+    return llmapi.UPSTREAM_REQUESTS._values.get((path, str(status)), 0)
+
+
+async def post_all(requests):
+    transport = httpx.ASGITransport(app=llmapi_asgi.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return [await client.post(path, json=body) for path, body in requests]
+    finally:
+        # The upstream clients belong to this event loop; the next test runs another
+        for _, upstream in list(llmapi_asgi.clients.values()):
+            await upstream.aclose()
+        llmapi_asgi.clients.clear()
+
+
+def test_chat_records_upstream_metrics_like_flask(make_app):
+    make_app()
+    before = upstream_count("/api/chat"), requests_with_status("/api/chat", 200)
+    chat = {"user_id": "asgi", "model": "llama3:latest", "use_context": False}
+
+    responses = asyncio.run(post_all([
+        ("/chat", {**chat, "message": "plain"}),
+        ("/chat", {**chat, "message": "streamed", "stream": True})
+    ]))
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert upstream_count("/api/chat") == before[0] + 2
+    assert requests_with_status("/api/chat", 200) == before[1] + 2
+
+
+def test_connection_failures_count_against_the_backend(make_app):
+    make_app()
+    backend = llmapi.Backend("http://127.0.0.1:1", retries=0, max_failures=3)
+    before = requests_with_status("/api/tags", "error")
+
+    async def call():
+        try:
+            await llmapi_asgi.send_upstream(backend, "GET", "/api/tags")
+        except httpx.ConnectError:
+            return True
+        finally:
+            await llmapi_asgi.clients.pop(backend.name)[1].aclose()
+        return False
+
+    assert asyncio.run(call())
+    assert backend.failures == 1
+    assert requests_with_status("/api/tags", "error") == before + 1
+
+
+def test_stop_model_answers_like_flask(make_app):
+    flask_client = make_app().test_client()
+    requests = [("/stop-model", {"model": "missing:latest"}), ("/load-model", {"model": "qwen2:latest"}),
+                ("/stop-model", {"model": "qwen2:latest"}), ("/stop-loaded-model", {})]
+
+    asgi = [(response.status_code, response.json()) for response in asyncio.run(post_all(requests))]
+    flask = [(response.status_code, response.get_json()) for response in
+             (flask_client.post(path, json=body) for path, body in requests)]
+
+    assert asgi == flask
+    assert asgi[0] == (400, {"error": "Model missing:latest not found"})
+    assert asgi[2][1]["success"] is True
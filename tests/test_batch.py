@@ -0,0 +1,65 @@
+import threading
+import time
+
+import llmapi
+
+
+def post_batch(app, items, timings, name):
+    started = time.perf_counter()
+    response = app.test_client().post("/chat/batch", json={"items": items})
+    lines = [line for line in response.get_data().splitlines() if line]
+    timings[name] = (time.perf_counter() - started, response.status_code, len(lines))
+
+
+def test_large_batch_does_not_hold_up_another_model(make_app, fake_ollama):
+    app = make_app(batch_workers=4, scheduler={"default": {"max_in_flight": 1}})
+    fake_ollama.latency = 0.2
+    big = [{"user_id": f"big{i}", "message": f"big {i}", "model": "llama3:latest", "use_context": False}
+           for i in range(12)]
+    small = [{"user_id": "small", "message": "small", "model": "qwen2:latest", "use_context": False}]
+    timings = {}
+
+    first = threading.Thread(target=post_batch, args=(app, big, timings, "big"))
+    first.start()
+    time.sleep(0.3)
+    post_batch(app, small, timings, "small")
+    first.join()
+
+    assert timings["small"][1:] == (200, 1)
+    assert timings["big"][1:] == (200, 12)
+    # The small batch only waits for its own upstream call, not for the big batch's queue
+    assert timings["small"][0] < 1.0
+    assert timings["big"][0] > timings["small"][0]
+
+
+def test_batch_items_of_one_model_run_max_in_flight_at_a_time(make_app, fake_ollama, monkeypatch):
+    app = make_app(batch_workers=8, scheduler={"default": {"max_in_flight": 2}})
+    fake_ollama.latency = 0.05
+    running = []
+    peak = []
+    lock = threading.Lock()
+    acquire = llmapi.scheduler.acquire
+
+    def counting_acquire(model, user_id):
+        with lock:
+            running.append(model)
+            peak.append(len(running))
+        return acquire(model, user_id)
+
+    release = llmapi.scheduler.release
+
+    def counting_release(ticket):
+        with lock:
+            running.pop()
+        return release(ticket)
+
+    monkeypatch.setattr(llmapi.scheduler, "acquire", counting_acquire)
+    monkeypatch.setattr(llmapi.scheduler, "release", counting_release)
+    items = [{"user_id": f"u{i}", "message": f"m {i}", "model": "llama3:latest", "use_context": False}
+             for i in range(8)]
+    timings = {}
+    post_batch(app, items, timings, "batch")
+
+    assert timings["batch"][1:] == (200, 8)
+    # Items waiting on the scheduler would show up here; the batch only submits what can run
+    assert max(peak) <= 2
@@ -0,0 +1,29 @@
+import json
+import sqlite3
+
+import llmapi
+
+
+def test_migrate_skips_malformed_contexts(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "old.db"))
+    conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                 "role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL, created_at REAL NOT NULL)")
+    conn.execute("CREATE TABLE contexts (user_id TEXT PRIMARY KEY, context TEXT)")
+    conn.executemany("INSERT INTO contexts VALUES (?, ?)", [
+        ("good", json.dumps([{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])),
+        ("mixed", json.dumps([{"role": "user", "content": None}, "stray", {"role": "user", "content": "kept"}])),
+        ("not_a_list", json.dumps({"role": "user", "content": "hi"})),
+        ("not_json", "{oops"),
+        ("empty", None)
+    ])
+    conn.commit()
+
+    llmapi.migrate_context_blobs(conn)
+
+    rows = conn.execute("SELECT user_id, seq, role, content FROM messages ORDER BY user_id, seq").fetchall()
+    assert rows == [
+        ("good", 1, "user", "hi"),
+        ("good", 2, "assistant", "hello"),
+        ("mixed", 1, "user", "kept")
+    ]
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'contexts'").fetchone() is None
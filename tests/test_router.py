@@ -0,0 +1,35 @@
+import llmapi
+
+
+def make_backend(url, running):
+    backend = llmapi.Backend(url)
+    backend.available_models = lambda refresh=False: ["llama3:latest"]
+    backend.running_models = lambda refresh=False: list(running)
+    return backend
+
+
+def test_saturated_warm_backend_spills_over(monkeypatch):
+    monkeypatch.setattr(llmapi, "SCHEDULER", {"default": {"max_in_flight": 4}})
+    warm = make_backend("http://warm:11434", ["llama3:latest"])
+    cold = make_backend("http://cold:11434", [])
+    router = llmapi.BackendRouter([warm, cold], slots_for=llmapi.backend_slots)
+
+    leases = [router.acquire("llama3:latest", f"user{i}") for i in range(8)]
+
+    assert warm.model_in_flight["llama3:latest"] == 4
+    assert cold.model_in_flight["llama3:latest"] == 4
+    for lease in leases:
+        lease.release()
+    assert warm.in_flight == cold.in_flight == 0
+    assert warm.model_in_flight == cold.model_in_flight == {}
+
+
+def test_warm_backend_preferred_below_its_limit(monkeypatch):
+    monkeypatch.setattr(llmapi, "SCHEDULER", {"default": {"max_in_flight": 4}})
+    warm = make_backend("http://warm:11434", ["llama3:latest"])
+    cold = make_backend("http://cold:11434", [])
+    router = llmapi.BackendRouter([warm, cold], slots_for=llmapi.backend_slots)
+
+    leases = [router.acquire("llama3:latest") for _ in range(4)]
+
+    assert [lease.backend for lease in leases] == [warm] * 4
@@ -0,0 +1,25 @@
+import llmapi
+
+
+def chat(client, message):
+    return client.post("/chat", json={"user_id": "timing", "message": message, "model": "llama3:latest",
+                                      "use_context": False})
+
+
+def test_timings_do_not_carry_over_between_requests_on_one_thread(make_app):
+    client = make_app(server_timing=True).test_client()
+
+    first = chat(client, "first")
+    assert first.status_code == 200
+    stages = first.headers["Server-Timing"].split(", ")
+
+    for i in range(5):
+        response = client.post("/chat/batch", json=[{"user_id": f"b{i}", "message": f"batch {i}",
+                                                     "model": "llama3:latest", "use_context": False}])
+        assert response.status_code == 200
+        response.get_data()
+        assert "Server-Timing" not in response.headers
+        assert llmapi._request_timings.get() is None
+
+    second = chat(client, "second")
+    assert len(second.headers["Server-Timing"].split(", ")) == len(stages)